@@ -9,29 +9,34 @@ Author: Kilian Vos, Water Research Laboratory, University of New South Wales
 # load basic modules
 import time
 import os
+import json
+import pickle
+import hashlib
+import tempfile
+import random
+import re
 import numpy as np
 import matplotlib.pyplot as plt
 import pdb
-from typing import List, Dict, Union, Tuple
+from typing import List, Dict, Set, Union, Tuple
 import time
 from functools import wraps
 import traceback
 from datetime import timezone
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
+from itertools import compress
 
 # earth engine module
 import ee
 
-# modules to download, unzip and stack the images
-import requests
-from urllib.request import urlretrieve
-import zipfile
-import shutil
+# modules to download and stack the images
 from osgeo import gdal
 
 # additional modules
 from datetime import datetime, timedelta
-import pytz
-from skimage import morphology, transform
+from shapely.prepared import prep
 from scipy import ndimage
 
 # from tqdm import tqdm
@@ -40,13 +45,30 @@ import logging
 
 
 # CoastSat modules
-from coastsat import SDS_preprocess, SDS_tools, gdal_merge
+from coastsat import SDS_preprocess, SDS_tools
 from coastsat.SDS_preprocess import preprocess_single
 
 
 np.seterr(all="ignore")  # raise/ignore divisions by 0 and nans
 gdal.PushErrorHandler("CPLQuietErrorHandler")
 
+# maximum number of images downloaded in parallel (requests to the GEE high-volume endpoint)
+MAX_DOWNLOAD_WORKERS = 25
+# bounds the number of requests (pixels and getInfo) sent at once to GEE across all the
+# satellite and download threads, see ee_get_info
+EE_REQUEST_SEMAPHORE = threading.BoundedSemaphore(MAX_DOWNLOAD_WORKERS)
+# bounds the number of images resampled at once with gdal_warp (CPU-bound), so that the
+# download threads waiting on GEE are not slowed down by too many concurrent warps
+MAX_WARP_WORKERS = min(8, os.cpu_count() or 1)
+WARP_SEMAPHORE = threading.BoundedSemaphore(MAX_WARP_WORKERS)
+# size (in bytes) of the chunks in which the overlapping S2 images are merged
+MERGE_MEMORY_LIMIT = 64 * 1024 * 1024
+# version of the earthengine-api parsed once, versions up to 0.1.201 are not supported
+_EE_VERSION = tuple(int(x) for x in re.findall(r"\d+", ee.__version__)[:3])
+_EE_TOO_OLD = _EE_VERSION < (0, 1, 202)
+# time (in seconds) after which the cached lists of images available on GEE are refreshed
+GEE_CACHE_TTL = 24 * 60 * 60
+
 
 def release_logger(logger):
     """
@@ -106,32 +128,116 @@ class TooManyRequests(Exception):
 import functools  # retry v2
 
 
+# maximum number of attempts and maximum wait (in seconds) between two attempts of a GEE request
+RETRY_MAX_ATTEMPTS = 6
+RETRY_MAX_DELAY = 30
+# messages of the transient ee.EEException errors (throttling, quota, deadline and server
+# errors), the other ones (e.g. user memory limit, request size, missing band or asset)
+# fail the same way every time
+EE_RETRYABLE_MESSAGES = [
+    "too many",
+    "rate limit",
+    "quota",
+    "deadline",
+    "timed out",
+    "timeout",
+    "internal error",
+    "server error",
+    "service unavailable",
+    "backend error",
+    "temporarily unavailable",
+    "try again",
+]
+
+
+def get_error_response(error):
+    """
+    Returns the HTTP response attached to an error raised by a request (requests.HTTPError
+    and googleapiclient HttpError), None if the error has no response.
+    """
+    for attr in ["response", "resp"]:
+        response = getattr(error, attr, None)
+        # a requests.Response with an error status is falsy, compare to None
+        if response is not None:
+            return response
+    return None
+
+
+def is_retryable(error) -> bool:
+    """
+    Only the errors of the server or of the connection are retried: OSError (socket,
+    connection and requests errors), the HTTP errors with a timeout (408), throttling (429)
+    or server (5xx) status and the ee.EEException with one of the EE_RETRYABLE_MESSAGES
+    (the ee client raises them without a status). Other client errors (e.g. a bad request,
+    a missing asset or the user memory limit) and programming errors (TypeError, KeyError...)
+    fail the same way every time and are raised straight away.
+    """
+    response = get_error_response(error)
+    status = getattr(response, "status_code", getattr(response, "status", None))
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        status = None
+    if status is not None:
+        return status in [408, 429] or 500 <= status < 600
+    if isinstance(error, ee.EEException):
+        message = str(error).lower()
+        return any(text in message for text in EE_RETRYABLE_MESSAGES)
+    return isinstance(error, (OSError, TooManyRequests))
+
+
+def get_retry_delay(error, attempt: int) -> float:
+    """
+    Time to wait before the next attempt: the Retry-After header sent by the server if any,
+    otherwise an exponential backoff (1, 2, 4, ... seconds) with a random jitter so that
+    the download threads do not retry all at the same time.
+    """
+    response = get_error_response(error)
+    headers = getattr(response, "headers", response)
+    if hasattr(headers, "get"):
+        retry_after = headers.get("Retry-After", headers.get("retry-after"))
+        try:
+            return min(RETRY_MAX_DELAY, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    return min(RETRY_MAX_DELAY, 2 ** (attempt - 1) + random.uniform(0, 1))
+
+
 def retry(func):
     @functools.wraps(func)
     def wrapper_retry(*args, **kwargs):
         # Get image_id from kwargs or use 'Unknown'
         image_id = kwargs.get("image_id", "Unknown image id")
         logger = kwargs.get("logger", None)
-        max_attempts = 3
+        max_attempts = RETRY_MAX_ATTEMPTS
         for attempt in range(max_attempts):
             try:
-                # first attempt does not wait
-                if attempt > 0:
-                    time.sleep(1)
                 return func(*args, **kwargs)
             except Exception as e:
-                print(
-                    f"Attempt {attempt+1}/{max_attempts} failed with error: {type(e).__name__}"
-                )
+                if not is_retryable(e):
+                    print(
+                        f"{func.__name__} failed with error {type(e).__name__}, which is not retryable"
+                    )
+                    if logger:
+                        logger.error(
+                            f"{func.__name__} with image_id {image_id} failed with a non retryable error: {e}"
+                        )
+                    raise
                 if logger:
                     logger.warning(
-                        f"Retry {attempt + 1}/{max_attempts} for function {func.__name__} with image_id {kwargs.get('image_id', 'N/A')} due to {e}"
+                        f"Retry {attempt + 1}/{max_attempts} for function {func.__name__} with image_id {image_id} due to {e}"
+                    )
+                else:
+                    print(
+                        f"Attempt {attempt+1}/{max_attempts} failed with error: {type(e).__name__}"
                     )
                 if attempt == max_attempts - 1:
                     print(
                         f"Max retries {attempt+1}/{max_attempts}  exceeded for {func.__name__} due to {type(e).__name__}"
                     )
                     raise
+                # wait before the next attempt (exponential backoff with jitter)
+                time.sleep(get_retry_delay(e, attempt + 1))
 
     return wrapper_retry
 
@@ -142,43 +248,77 @@ def debug_kill_wifi():
     os.system("netsh wlan disconnect")
 
 
+def ee_get_info(ee_object):
+    """
+    Sends the getInfo request of an EE object (collection, image, list...) and returns
+    its value. Like the pixel requests of download_tif, the request is bounded by
+    EE_REQUEST_SEMAPHORE, which is held only during the request (not during the waits
+    between the attempts of the retry decorator).
+    """
+    with EE_REQUEST_SEMAPHORE:
+        return ee_object.getInfo()
+
+
+def get_region(polygon):
+    """
+    Returns the ee.Geometry of the polygon, so that it can be built once and reused
+    across the queries (an ee.Geometry is returned unchanged).
+
+    Args:
+        polygon (list or ee.Geometry): The coordinates of the polygon as a list of [longitude, latitude] pairs.
+
+    Returns:
+        ee.Geometry: The polygon as an Earth Engine geometry.
+    """
+    if isinstance(polygon, ee.Geometry):
+        return polygon
+    return ee.Geometry.Polygon(polygon)
+
+
 def get_images_list_from_collection(ee_col, polygon, dates):
     """
     Retrieves a list of images from a given Earth Engine collection within a specified polygon and date range.
 
     Args:
         ee_col (ee.ImageCollection): The Earth Engine collection to retrieve images from.
-        polygon (list): The coordinates of the polygon as a list of [longitude, latitude] pairs.
+        polygon (list or ee.Geometry): The coordinates of the polygon as a list of [longitude, latitude] pairs.
         dates (list): The start and end dates of the date range as a list of strings in the format "YYYY-MM-DD".
 
     Returns:
         list: A list of images in the collection that satisfy the given polygon and date range.
     """
-    col = ee_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(dates[0], dates[1])
-    col_size = col.size().getInfo()
+    ee_col = ee_col.filterBounds(get_region(polygon))
+    col = ee_col.filterDate(dates[0], dates[1])
+    col_size = ee_get_info(col.size())
 
     im_list = []
     # the max size of the collection is 5000, so we need to split the collection if it is larger
     if col_size > 4999:
-        num_splits = 2
+        # first guess from the size of the collection, then double the number of splits
+        # until all the sub-collections are small enough
+        num_splits = max(2, int(np.ceil(col_size / 4999)))
         split_ranges = split_date_range(dates[0], dates[1], num_splits)
         while True:
-            sub_col_sizes = []
-            for start_date, end_date in split_ranges:
-                sub_col = ee_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(start_date, end_date)
-                sub_col_size = sub_col.size().getInfo()
-                sub_col_sizes.append(sub_col_size)
-            
+            # the sizes of all the sub-collections are computed in a single request
+            sub_col_sizes = ee_get_info(
+                ee.List(
+                    [
+                        ee_col.filterDate(start_date, end_date).size()
+                        for start_date, end_date in split_ranges
+                    ]
+                )
+            )
+
             if all(size <= 4999 for size in sub_col_sizes):
                 break
-            num_splits += 1
+            num_splits *= 2
             split_ranges = split_date_range(dates[0], dates[1], num_splits)
 
         for start_date, end_date in split_ranges:
-            sub_col = ee_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(start_date, end_date)
-            im_list.extend(sub_col.getInfo().get("features"))
+            sub_col = ee_col.filterDate(start_date, end_date)
+            im_list.extend(ee_get_info(sub_col).get("features"))
     else:
-        im_list = col.getInfo().get("features")
+        im_list = ee_get_info(col).get("features")
     return im_list
 
 def split_date_range(start_date, end_date, num_splits):
@@ -250,15 +390,50 @@ def get_tier1_images(inputs, polygon, dates, scene_cloud_cover, months_list):
         "L9": "LANDSAT/LC09/C02/T1_TOA",
         "S2": "COPERNICUS/S2_HARMONIZED",
     }
-    im_dict_T1 = dict([])
+    im_dict_T1 = fetch_image_lists(inputs, col_names_T1, inputs["sat_list"], polygon, dates, scene_cloud_cover, months_list)
     for satname in inputs["sat_list"]:
-        im_list = get_image_info(col_names_T1[satname], satname, polygon, dates, S2tile=inputs.get("S2tile", ""), scene_cloud_cover=scene_cloud_cover, months_list=months_list)
         if satname == "S2":
-            im_list = filter_S2_collection(im_list)
-        print("     %s: %d images" % (satname, len(im_list)))
-        im_dict_T1[satname] = im_list
+            im_dict_T1[satname] = filter_S2_collection(im_dict_T1[satname])
+        print("     %s: %d images" % (satname, len(im_dict_T1[satname])))
     return im_dict_T1
 
+
+def fetch_image_lists(inputs, col_names, sat_list, polygon, dates, scene_cloud_cover, months_list):
+    """
+    Queries the GEE collections of several satellite missions concurrently (each query
+    is a blocking request dominated by the network latency).
+
+    Args:
+        inputs (dict): A dictionary containing input parameters.
+        col_names (dict): The name of the GEE collection of each satellite mission.
+        sat_list (list): The satellite missions to query.
+        polygon (list): The polygon representing the area of interest.
+        dates (list): A list of dates to filter the images.
+        scene_cloud_cover (float): The maximum cloud cover percentage allowed for the images.
+        months_list (list): A list of months to filter the images.
+
+    Returns:
+        dict: The list of images of each satellite mission.
+    """
+    if len(sat_list) == 0:
+        return dict([])
+    with ThreadPoolExecutor(max_workers=len(sat_list)) as executor:
+        futures = {
+            satname: executor.submit(
+                _cached_image_info,
+                inputs,
+                col_names[satname],
+                satname,
+                polygon,
+                dates,
+                S2tile=inputs.get("S2tile", ""),
+                scene_cloud_cover=scene_cloud_cover,
+                months_list=months_list,
+            )
+            for satname in sat_list
+        }
+        return {satname: future.result() for satname, future in futures.items()}
+
 def remove_existing_images_if_needed(inputs, im_dict_T1):
     """
     Removes existing images if needed based on the provided inputs.
@@ -297,13 +472,11 @@ def get_tier2_images(inputs, polygon, dates_str, scene_cloud_cover, months_list)
         "L7": "LANDSAT/LE07/%s/T2_TOA" % inputs["landsat_collection"],
         "L8": "LANDSAT/LC08/%s/T2_TOA" % inputs["landsat_collection"],
     }
-    im_dict_T2 = dict([])
-    for satname in inputs["sat_list"]:
-        if satname in ["L9", "S2"]:
-            continue  # no Tier 2 for Sentinel-2 and Landsat 9
-        im_list = get_image_info(col_names_T2[satname], satname, polygon, dates_str, S2tile=inputs.get("S2tile", ""), scene_cloud_cover=scene_cloud_cover, months_list=months_list)
-        print("     %s: %d images" % (satname, len(im_list)))
-        im_dict_T2[satname] = im_list
+    # no Tier 2 for Sentinel-2 and Landsat 9
+    sat_list = [satname for satname in inputs["sat_list"] if satname not in ["L9", "S2"]]
+    im_dict_T2 = fetch_image_lists(inputs, col_names_T2, sat_list, polygon, dates_str, scene_cloud_cover, months_list)
+    for satname in sat_list:
+        print("     %s: %d images" % (satname, len(im_dict_T2[satname])))
     return im_dict_T2
 
 def check_dates_order(dates):
@@ -380,26 +553,19 @@ def filter_images_by_month(im_list, satname, months_list,**kwargs):
     im_list_upt: list
         updated list of images
     """
+    # set of months for constant-time membership tests
+    months_set = set(months_list)
     if satname in ["L5", "L7", "L8", "L9"]:
         property_name = "DATE_ACQUIRED"
-        # get the properties of the images
-        img_properties = [_["properties"][property_name] for _ in im_list]
         img_months = [datetime.strptime(img["properties"][property_name], '%Y-%m-%d').month for img in im_list]
-        if np.any([img_month not in months_list for img_month in img_months]):
-            # drop all the images that are not in the months_list
-            idx_delete = np.where([datetime.strptime(date_acquired,'%Y-%m-%d').month not in months_list for date_acquired in img_properties])[0]
-            im_list_upt = [x for k, x in enumerate(im_list) if k not in idx_delete]
-        else:
-            im_list_upt = im_list
     elif satname in ["S2"]:
         property_name = 'system:time_start'
-        img_properties = [_["properties"][property_name] for _ in im_list]
         img_months = [datetime.fromtimestamp(img["properties"][property_name] / 1000.0).month for img in im_list]
-        if np.any([img_month not in months_list for img_month in img_months]):
-            idx_delete = np.where([datetime.fromtimestamp(date_acquired / 1000.0).month not in months_list for date_acquired in img_properties])[0]
-            im_list_upt = [x for k, x in enumerate(im_list) if k not in idx_delete]
-        else:
-            im_list_upt = im_list
+    # drop all the images that are not in the months_list (the months are computed once)
+    if all(img_month in months_set for img_month in img_months):
+        im_list_upt = im_list
+    else:
+        im_list_upt = [x for x, img_month in zip(im_list, img_months) if img_month in months_set]
     
     return im_list_upt
 
@@ -416,8 +582,8 @@ def get_image_info(collection, satname, polygon, dates, scene_cloud_cover:float=
         name of the collection (e.g. 'LANDSAT/LC08/C02/T1_TOA')
     satname: str
         name of the satellite mission
-    polygon: list
-        coordinates of the polygon in lat/lon
+    polygon: list or ee.Geometry
+        coordinates of the polygon in lat/lon (or the ee.Geometry built from them)
     dates: list of str
         start and end dates (e.g. '2022-01-01')
     scene_cloud_cover: float (default: 0.95)
@@ -437,8 +603,9 @@ def get_image_info(collection, satname, polygon, dates, scene_cloud_cover:float=
     
     # get info about images
     ee_col = ee.ImageCollection(collection)
+    polygon = get_region(polygon)
     # Initialize the collection with filterBounds and filterDate
-    col = ee_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(
+    col = ee_col.filterBounds(polygon).filterDate(
         dates[0], dates[1]
     )
     # If "S2tile" key is in kwargs and its associated value is truthy (not an empty string, None, etc.),
@@ -455,17 +622,87 @@ def get_image_info(collection, satname, polygon, dates, scene_cloud_cover:float=
     im_list = filter_images_by_month(im_list, satname, kwargs.get("months_list", [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11,12,]))
     return im_list
 
+def _cached_image_info(inputs, collection, satname, polygon, dates, **kwargs):
+    """
+    Wrapper around get_image_info that stores the list of images returned by GEE in
+    a pickle file under <filepath>/<sitename>/.gee_cache, so that running again over
+    the same ROI and dates does not repeat the queries. The cached lists expire
+    after GEE_CACHE_TTL seconds. The cache is only written if the folder of the site
+    already exists.
+
+    Arguments:
+    -----------
+    inputs: dict
+        inputs dictionary, 'filepath' and 'sitename' give the location of the cache
+    collection, satname, polygon, dates, **kwargs:
+        arguments of get_image_info
+
+    Returns:
+    -----------
+    im_list: list
+        list with the info for the images
+    """
+    if not inputs.get("filepath") or not inputs.get("sitename"):
+        return get_image_info(collection, satname, polygon, dates, **kwargs)
+    # the key identifies the query (not the site), the dates can be str or datetime
+    query = {
+        "collection": collection,
+        "satname": satname,
+        "polygon": polygon.toGeoJSON()["coordinates"] if isinstance(polygon, ee.Geometry) else polygon,
+        "dates": [str(_) for _ in dates],
+        "scene_cloud_cover": kwargs.get("scene_cloud_cover", 0.95),
+        "months_list": kwargs.get("months_list"),
+        "S2tile": kwargs.get("S2tile", ""),
+    }
+    key = hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+    site_folder = os.path.join(inputs["filepath"], inputs["sitename"])
+    cache_dir = os.path.join(site_folder, ".gee_cache")
+    fn_cache = os.path.join(cache_dir, key + ".pkl")
+    if os.path.exists(fn_cache) and time.time() - os.path.getmtime(fn_cache) < GEE_CACHE_TTL:
+        try:
+            with open(fn_cache, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass  # corrupted cache file, query GEE again
+    im_list = get_image_info(collection, satname, polygon, dates, **kwargs)
+    # the cache is only written in the folder of an existing site (created by retrieve_images
+    # before the queries), checking the available images does not create the folder
+    if not os.path.isdir(site_folder):
+        return im_list
+    # write to a temporary file first so that an interrupted run does not leave a truncated cache
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, fn_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(im_list, f)
+    SDS_tools.set_default_permissions(fn_tmp)
+    os.replace(fn_tmp, fn_cache)
+    return im_list
+
+
+def get_band_projection(im_meta: dict, band_id: str) -> dict:
+    """
+    Returns the projection (keys 'crs' and 'transform') of a band of an EE image.
+    It is read from the band metadata of the image (crs and crs_transform), which
+    comes with the collection info, so no request is sent to GEE.
+    """
+    band = next(band for band in im_meta["bands"] if band["id"] == band_id)
+    return {"crs": band["crs"], "transform": band["crs_transform"]}
+
+
 @retry
-def remove_dimensions_from_bands(image_ee, **kwargs):
-    # first delete dimensions key from dictionary
+def remove_dimensions_from_bands(image_ee, band_ids=None, **kwargs):
+    # keep only the bands to download (if band_ids is given) and remove some additional
+    # masks provided with S2, in a single pass over the bands of the image
+    band_ids = None if band_ids is None else set(band_ids)
+    im_bands = [
+        band
+        for band in ee_get_info(image_ee)["bands"]
+        if "MSK_CLASSI" not in band["id"] and (band_ids is None or band["id"] in band_ids)
+    ]
+    # then delete dimensions key from dictionary of the remaining bands
     # otherwise the entire image is extracted (don't know why)
-    im_bands = image_ee.getInfo()["bands"]
-    
-    # remove some additional masks provided with S2
-    im_bands = [band for band in im_bands if 'MSK_CLASSI' not in band['id']]
-    for j in range(len(im_bands)):
-        if "dimensions" in im_bands[j]:
-            del im_bands[j]["dimensions"]
+    for band in im_bands:
+        band.pop("dimensions", None)
     return im_bands
 
 
@@ -552,7 +789,7 @@ def get_georeference_accuracy(satname: str, im_meta: dict) -> str:
 
 
 def handle_duplicate_image_names(
-    all_names: List[str],
+    all_names: Set[str],
     bands: Dict[str, str],
     im_fn: Dict[str, str],
     im_date: str,
@@ -565,7 +802,7 @@ def handle_duplicate_image_names(
     it adds a '_dupX' suffix to the name (where 'X' is a counter for the number of duplicates).
 
     Parameters:
-    all_names (list): A list containing all image file names that have been handled so far.
+    all_names (set): A set containing all image file names that have been handled so far.
     bands (dict): A dictionary where the keys are the band names.
     im_fn (dict): A dictionary where the keys are the band names and the values are the current file names for each band.
     im_date (str): A string representing the date when the image was taken.
@@ -593,6 +830,36 @@ def filter_bands(bands_source, band_ids):
     return [band for band in bands_source if band["id"] in band_ids]
 
 
+def get_band_groups(satname: str, bands_id: List[str]) -> Dict[str, frozenset]:
+    """
+    Splits the ids of the bands of a satellite mission into the groups saved in
+    separate .tif files, as frozensets for constant time membership tests.
+
+    Arguments:
+    -----------
+    satname: str
+        name of the satellite mission
+    bands_id: list of str
+        ids of the bands to download (see bands_dict in retrieve_images)
+
+    Returns:
+    -----------
+    band_groups: dict of frozenset
+        'ms' (multispectral and QA bands) and 'pan' (panchromatic band) for Landsat 7, 8, 9,
+        'ms' (10m RGB+NIR+s2cloudless), 'swir' (20m SWIR1) and 'mask' (60m QA band) for S2
+    """
+    if satname == "S2":
+        return {
+            "ms": frozenset(bands_id[:5]),
+            "swir": frozenset(bands_id[5:6]),
+            "mask": frozenset(bands_id[-1:]),
+        }
+    band_groups = {"ms": frozenset(bands_id)}
+    if satname in ["L7", "L8", "L9"]:
+        band_groups["pan"] = frozenset(["B8"])
+    return band_groups
+
+
 def merge_image_tiers(inputs, im_dict_T1, im_dict_T2):
     """
     Merges im_dict_T2 into im_dict_T1 based on the keys provided in inputs["sat_list"].
@@ -647,21 +914,22 @@ def check_images_available(inputs, months_list=None, scene_cloud_cover=0.95,tier
     if months_list is None:
         months_list = list(range(1, 13))
     
-    dates = [datetime.strptime(_, "%Y-%m-%d") for _ in inputs["dates"]]
+    # the dates are only compared here, GEE is queried with the 'YYYY-MM-DD' strings
+    dates = np.array(inputs["dates"], dtype="datetime64[D]")
     dates_str = inputs["dates"]
-    polygon = inputs["polygon"]
-
     im_dict_T2 = {}
     im_dict_T1 = {}
     
     check_dates_order(dates)
     initialize_ee()
+    # build the geometry once, it is shared by the queries of all the collections
+    polygon = get_region(inputs["polygon"])
     # check_collection(inputs["landsat_collection"])
 
     print("Number of images available between %s and %s:" % (dates_str[0], dates_str[1]), end="\n")
 
     if tier1:
-        im_dict_T1 = get_tier1_images(inputs, polygon, dates, scene_cloud_cover, months_list)
+        im_dict_T1 = get_tier1_images(inputs, polygon, dates_str, scene_cloud_cover, months_list)
         im_dict_T1 = remove_existing_images_if_needed(inputs, im_dict_T1)
 
     sum_img = sum(len(im_dict_T1[satname]) for satname in im_dict_T1)
@@ -679,6 +947,524 @@ def check_images_available(inputs, months_list=None, scene_cloud_cover=0.95,tier
 
     return im_dict_T1, im_dict_T2
 
+def _process_one_image(
+    i,
+    im_meta,
+    satname,
+    inputs,
+    filepaths,
+    tif_paths,
+    name_format,
+    band_groups,
+    all_names,
+    names_lock,
+    im_s2cloudless,
+    logger,
+    cloud_threshold,
+    cloud_mask_issue,
+    save_jpg,
+    apply_cloud_mask,
+    max_cloud_no_data_cover,
+):
+    """
+    Downloads a single image (all its bands) and resamples the bands on the same pixel
+    grid. Runs in a worker thread of retrieve_images.
+
+    Arguments:
+    -----------
+    i: int
+        index of the image in the list of images of the satellite mission
+    im_meta: dict
+        metadata of the image (from the EE collection)
+    satname: str
+        name of the satellite mission
+    inputs: dict
+        inputs dictionary (see retrieve_images)
+    filepaths: list of str
+        folders of the satellite mission (output of SDS_tools.create_folder_structure)
+    tif_paths: list of str
+        folders of the .tif files of the satellite mission (output of SDS_tools.get_filepath)
+    name_format: str
+        template of the image filenames with the {date} and {key} fields
+    band_groups: dict of frozenset
+        ids of the bands to download in each .tif file (output of get_band_groups)
+    all_names: set of str
+        filenames of the images already downloaded, used to detect duplicates
+    names_lock: threading.Lock
+        lock guarding all_names, shared by the worker threads
+    im_s2cloudless: dict or list
+        metadata of the matching s2cloudless image (S2 only)
+    logger: logging.Logger
+        logger of the download session
+
+    The remaining arguments are the ones of retrieve_images.
+
+    Returns:
+    -----------
+    (filename_txt, metadict, image_id): tuple or None
+        name of the metadata .txt file, metadata of the image and its GEE id,
+        None if the image was not downloaded. If the image was filtered out by
+        its cloud cover, filename_txt and metadict are None
+    """
+    # initalize the variables
+    # store the bands availble
+    bands = dict([])
+    # dictionary containing the filepaths for each type of file downloaded
+    im_fn = dict([])
+    metadict = None
+    suffix = ".tif"
+    try:
+        # get time of acquisition (UNIX time) and convert to datetime
+        acquisition_time = im_meta["properties"]["system:time_start"]
+        im_timestamp = datetime.fromtimestamp(acquisition_time / 1000, tz=timezone.utc)
+        im_date = im_timestamp.strftime("%Y-%m-%d-%H-%M-%S")
+
+        # get epsg code
+        im_epsg = int(im_meta["bands"][0]["crs"][5:])
+
+        # get quality flags (geometric and radiometric quality)
+        accuracy_georef = get_georeference_accuracy(satname, im_meta)
+        image_quality = get_image_quality(satname, im_meta)
+
+        # select image by id
+        image_ee = ee.Image(im_meta["id"])
+        # for S2 add s2cloudless probability band
+        if satname == "S2":
+            if len(im_s2cloudless) == 0:
+                raise Exception(
+                    "could not find matching s2cloudless image, raise issue on Github at"
+                    + "https://github.com/kvos/CoastSat/issues and provide your inputs."
+                )
+            im_cloud = ee.Image(im_s2cloudless["id"])
+            cloud_prob = im_cloud.select("probability").rename("s2cloudless")
+            image_ee = image_ee.addBands(cloud_prob)
+
+        # first delete dimensions key from dictionary
+        # otherwise the entire image is extracted (don't know why)
+        im_bands = remove_dimensions_from_bands(
+            image_ee,
+            frozenset().union(*band_groups.values()),
+            image_id=im_meta["id"],
+            logger=logger,
+        )
+        # select the bands of each .tif file (the order of the bands of the image is kept)
+        bands = {key: filter_bands(im_bands, ids) for key, ids in band_groups.items()}
+
+        # =============================================================================================#
+        # Landsat 5 download
+        # =============================================================================================#
+        if satname == "L5":
+            fp_ms = filepaths[1]
+            fp_mask = filepaths[2]
+            # adjust polygon to match image coordinates so that there is no resampling
+            proj = get_band_projection(im_meta, "B1")
+            rect = adjust_polygon(
+                inputs["polygon"], proj, image_id=im_meta["id"], logger=logger
+            )
+            # download .tif from EE (one file with ms bands and one file with QA band)
+            fn_ms, fn_QA = download_tif(
+                image_ee,
+                get_pixel_grid(rect, proj, bands["ms"][0]),
+                bands["ms"],
+                fp_ms,
+                satname,
+                image_id=im_meta["id"],
+                logger=logger,
+            )
+            # create filename for image
+            for key in bands.keys():
+                im_fn[key] = name_format.format(date=im_date, key=key)
+            # if multiple images taken at the same date add 'dupX' to the name (duplicate number X)
+            with names_lock:
+                im_fn = handle_duplicate_image_names(
+                    all_names,
+                    bands,
+                    im_fn,
+                    im_date,
+                    satname,
+                    inputs["sitename"],
+                    suffix,
+                )
+                all_names.add(im_fn["ms"])
+            im_fn["mask"] = im_fn["ms"].replace("_ms", "_mask")
+            filename_ms = im_fn["ms"]
+
+            filepath_ms = os.path.join(fp_ms, im_fn["ms"])
+            filepath_QA = os.path.join(fp_mask, im_fn["mask"])
+            try:
+                # resample ms bands to 15m with bilinear interpolation
+                warp_image_to_target(
+                    fn_ms,
+                    filepath_ms,
+                    fn_ms,
+                    double_res=True,
+                    resampling_method="bilinear",
+                )
+                # resample QA band to 15m with nearest-neighbour interpolation
+                warp_image_to_target(
+                    fn_QA,
+                    filepath_QA,
+                    fn_QA,
+                    double_res=True,
+                    resampling_method="near",
+                )
+            finally:
+                # delete original downloads (kept in memory)
+                remove_temporary_files([fn_ms, fn_QA])
+
+            fn = [filepath_ms, filepath_QA]
+
+        # =============================================================================================#
+        # Landsat 7, 8 and 9 download
+        # =============================================================================================#
+        elif satname in ["L7", "L8", "L9"]:
+            fp_ms = filepaths[1]
+            fp_pan = filepaths[2]
+            fp_mask = filepaths[3]
+            # adjust polygon for both ms and pan bands
+            proj_ms = get_band_projection(im_meta, "B1")
+            proj_pan = get_band_projection(im_meta, "B8")
+            rect_ms = adjust_polygon(
+                inputs["polygon"],
+                proj_ms,
+                image_id=im_meta["id"],
+                logger=logger,
+            )
+            rect_pan = adjust_polygon(
+                inputs["polygon"],
+                proj_pan,
+                image_id=im_meta["id"],
+                logger=logger,
+            )
+
+            # download both ms and pan bands from EE (the two requests are sent concurrently)
+            with ThreadPoolExecutor(max_workers=2) as band_executor:
+                future_ms = band_executor.submit(
+                    download_tif,
+                    image_ee,
+                    get_pixel_grid(rect_ms, proj_ms, bands["ms"][0]),
+                    bands["ms"],
+                    fp_ms,
+                    satname,
+                    image_id=im_meta["id"],
+                    logger=logger,
+                )
+                future_pan = band_executor.submit(
+                    download_tif,
+                    image_ee,
+                    get_pixel_grid(rect_pan, proj_pan, bands["pan"][0]),
+                    bands["pan"],
+                    fp_pan,
+                    satname,
+                    image_id=im_meta["id"],
+                )
+                fn_ms, fn_QA = future_ms.result()
+                fn_pan = future_pan.result()
+            # create filename for both images (ms and pan)
+            for key in bands.keys():
+                im_fn[key] = name_format.format(date=im_date, key=key)
+            # if multiple images taken at the same date add 'dupX' to the name (duplicate number X)
+            with names_lock:
+                im_fn = handle_duplicate_image_names(
+                    all_names,
+                    bands,
+                    im_fn,
+                    im_date,
+                    satname,
+                    inputs["sitename"],
+                    suffix,
+                )
+                all_names.add(im_fn["ms"])
+            im_fn["mask"] = im_fn["ms"].replace("_ms", "_mask")
+            filename_ms = im_fn["ms"]
+
+            filepath_ms = os.path.join(fp_ms, im_fn["ms"])
+            filepath_QA = os.path.join(fp_mask, im_fn["mask"])
+            try:
+                # resample the ms bands to the pan band with bilinear interpolation (for pan-sharpening later)
+                warp_image_to_target(
+                    fn_ms,
+                    filepath_ms,
+                    fn_pan,
+                    double_res=False,
+                    resampling_method="bilinear",
+                )
+                # resample QA band to the pan band with nearest-neighbour interpolation
+                warp_image_to_target(
+                    fn_QA,
+                    filepath_QA,
+                    fn_pan,
+                    double_res=False,
+                    resampling_method="near",
+                )
+            finally:
+                # delete original downloads (kept in memory)
+                remove_temporary_files([fn_ms, fn_QA])
+
+            # rename pan band
+            try:
+                os.rename(fn_pan, os.path.join(fp_pan, im_fn["pan"]))
+            except:
+                os.remove(os.path.join(fp_pan, im_fn["pan"]))
+                os.rename(fn_pan, os.path.join(fp_pan, im_fn["pan"]))
+            filepath_pan = os.path.join(fp_pan, im_fn["pan"])
+            fn = [filepath_ms, filepath_pan, filepath_QA]
+
+        # =============================================================================================#
+        # Sentinel-2 download
+        # =============================================================================================#
+        elif satname in ["S2"]:
+            fp_ms = filepaths[1]
+            fp_swir = filepaths[2]
+            fp_mask = filepaths[3]
+            # adjust polygon on the 60m grid (B1), which is also aligned with
+            # the 10m (RGB, NIR) and 20m (SWIR1) grids of the tile, so the same
+            # rectangle is used for the ms, swir and QA bands
+            proj = get_band_projection(im_meta, "B1")
+            rect = adjust_polygon(
+                inputs["polygon"],
+                proj,
+                image_id=im_meta["id"],
+                logger=logger,
+            )
+            # download the ms, swir and QA bands from EE (the three requests are sent concurrently)
+            with ThreadPoolExecutor(max_workers=3) as band_executor:
+                futures = [
+                    band_executor.submit(
+                        download_tif,
+                        image_ee,
+                        get_pixel_grid(rect, proj, bands[key][0]),
+                        bands[key],
+                        fp,
+                        satname,
+                        image_id=im_meta["id"],
+                        logger=logger,
+                        # the swir and QA bands are only read by the warp, keep them in memory
+                        in_memory=key != "ms",
+                    )
+                    for key, fp in zip(["ms", "swir", "mask"], [fp_ms, fp_swir, fp_mask])
+                ]
+                fn_ms, fn_swir, fn_QA = [future.result() for future in futures]
+
+            # create filename for the three images (ms, swir and mask)
+            for key in bands.keys():
+                im_fn[key] = name_format.format(date=im_date, key=key)
+            # if multiple images taken at the same date add 'dupX' to the name (duplicate)
+            with names_lock:
+                im_fn = handle_duplicate_image_names(
+                    all_names,
+                    bands,
+                    im_fn,
+                    im_date,
+                    satname,
+                    inputs["sitename"],
+                    suffix,
+                )
+                all_names.add(im_fn["ms"])
+            filename_ms = im_fn["ms"]
+
+            filepath_swir = os.path.join(fp_swir, im_fn["swir"])
+            filepath_QA = os.path.join(fp_mask, im_fn["mask"])
+            try:
+                # resample the 20m swir band to the 10m ms band with bilinear interpolation
+                warp_image_to_target(
+                    fn_swir,
+                    filepath_swir,
+                    fn_ms,
+                    double_res=False,
+                    resampling_method="bilinear",
+                )
+                # resample 60m QA band to the 10m ms band with nearest-neighbour interpolation
+                warp_image_to_target(
+                    fn_QA,
+                    filepath_QA,
+                    fn_ms,
+                    double_res=False,
+                    resampling_method="near",
+                )
+            finally:
+                # delete original downloads (kept in memory)
+                remove_temporary_files([fn_swir, fn_QA])
+            # rename the multispectral band file
+            dst = os.path.join(fp_ms, im_fn["ms"])
+            filepath_ms = os.path.join(fp_ms, im_fn["ms"])
+            if not os.path.exists(dst):
+                os.rename(fn_ms, dst)
+
+            fn = [filepath_ms, filepath_swir, filepath_QA]
+
+        # Removes images whose cloud cover and no data coverage exceeds the threshold
+        skip_image = SDS_preprocess.filter_images_by_cloud_cover_nodata(fn, satname, cloud_mask_issue, max_cloud_no_data_cover, cloud_threshold, do_cloud_mask=True, s2cloudless_prob=60)
+        # if the images was filtered out, skip the image being saved as a jpg
+        # (it is recorded in metadata.ndjson so that it is not downloaded again)
+        if skip_image:
+            return None, None, im_meta["id"]
+
+        # get image dimensions (width and height)
+        width, height = SDS_tools.get_image_dimensions(filepath_ms)
+        # metadata of the image, written in a text file by retrieve_images
+        filename_txt = im_fn["ms"].replace("_ms", "").replace(".tif", "")
+        metadict = {
+            "filename": filename_ms,
+            "epsg": im_epsg,
+            "acc_georef": accuracy_georef,
+            "image_quality": image_quality,
+            "im_width": width,
+            "im_height": height,
+        }
+        logger.info(
+            f"Successfully downloaded image id {im_meta.get('id','unknown')} as {im_fn.get('ms')}"
+        )
+
+        if save_jpg:
+            SDS_preprocess.save_single_jpg(
+                filename=im_fn["ms"],
+                tif_paths=tif_paths,
+                satname=satname,
+                sitename=inputs["sitename"],
+                cloud_thresh=cloud_threshold,
+                cloud_mask_issue=cloud_mask_issue,
+                filepath_data=inputs["filepath"],
+                collection=inputs["landsat_collection"],
+                apply_cloud_mask=apply_cloud_mask,
+            )
+    except Exception as error:
+        print(
+            f"\nThe download for satellite {satname} image '{im_meta.get('id','unknown')}' failed due to {type(error).__name__ }"
+        )
+        print(error)
+        logger.error(
+            f"The download for satellite {satname} {im_meta.get('id','unknown')} failed due to \n {error} \n Traceback {traceback.format_exc()}"
+        )
+    # the metadata is kept if the .tif files were saved (even if the .jpg failed)
+    if metadict is None:
+        return None
+    return filename_txt, metadict, im_meta["id"]
+
+
+def _download_satellite(
+    satname,
+    im_list,
+    im_list_s2cloudless,
+    inputs,
+    im_folder,
+    bands_id,
+    logger,
+    position,
+    cloud_threshold,
+    cloud_mask_issue,
+    save_jpg,
+    apply_cloud_mask,
+    max_cloud_no_data_cover,
+):
+    """
+    Downloads all the images of a satellite mission with a pool of threads (one image
+    per thread) and writes their metadata. Runs in a worker thread of retrieve_images.
+
+    Arguments:
+    -----------
+    satname: str
+        name of the satellite mission
+    im_list: list of dict
+        metadata of the images to download (from the EE collection)
+    im_list_s2cloudless: list of dict
+        metadata of the matching s2cloudless images (S2 only, empty list otherwise)
+    inputs: dict
+        inputs dictionary (see retrieve_images)
+    im_folder: str
+        directory of the site where the images are saved
+    bands_id: list of str
+        ids of the bands to download for this satellite mission
+    logger: logging.Logger
+        logger of the download session
+    position: int
+        line of the progress bar of this satellite mission
+
+    The remaining arguments are the ones of retrieve_images.
+
+    Returns:
+    -----------
+    None
+    """
+    # create subfolder structure to store the different bands
+    filepaths = SDS_tools.create_folder_structure(im_folder, satname)
+    # initialise variables and loop through images
+    band_groups = get_band_groups(satname, bands_id)
+    all_names = set()  # set for detecting duplicates (constant time lookup)
+    names_lock = threading.Lock()
+    # location of the tif folders for that satellite (e.g. S2 has /ms /swir /mask)
+    # and template of the filenames, the same for all the images of the satellite
+    tif_paths = SDS_tools.get_filepath(inputs, satname)
+    name_format = f"{{date}}_{satname}_{inputs['sitename']}_{{key}}.tif"
+    if len(im_list) == 0:
+        print(f"{inputs['sitename']}: No images to download for {satname}")
+        return
+    # skip the images that were already downloaded by a previous run, recorded in
+    # metadata.ndjson with their .txt file still in the meta folder (their names are
+    # reserved so that the duplicates of the new images are numbered after them),
+    # the images filtered out by their cloud cover with the same parameters and the
+    # images merged into another one by merge_overlapping_images
+    sat_folder = os.path.dirname(filepaths[0])
+    rows, skipped = read_metadata_index(sat_folder)
+    downloaded = {row["id"]: row for row in rows.values() if row["id"] is not None}
+    filters = get_filter_params(cloud_threshold, cloud_mask_issue, max_cloud_no_data_cover)
+    idx_new = []
+    for i, im_meta in enumerate(im_list):
+        row = downloaded.get(im_meta["id"])
+        if row is not None and os.path.isfile(os.path.join(filepaths[0], row["txt"])):
+            all_names.add(row["filename"])
+        elif skipped.get(im_meta["id"]) not in [filters, "merged"]:
+            idx_new.append(i)
+    if len(idx_new) < len(im_list):
+        print(
+            f"{inputs['sitename']}: {len(im_list) - len(idx_new)} {satname} images already downloaded, merged or filtered out, {len(idx_new)} to download"
+        )
+    if len(idx_new) == 0:
+        return
+    # download the images in parallel, the work is dominated by the wait on the GEE server
+    n_workers = min(MAX_DOWNLOAD_WORKERS, len(idx_new))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                _process_one_image,
+                i,
+                im_meta,
+                satname,
+                inputs,
+                filepaths,
+                tif_paths,
+                name_format,
+                band_groups,
+                all_names,
+                names_lock,
+                im_list_s2cloudless[i] if satname == "S2" else [],
+                logger,
+                cloud_threshold,
+                cloud_mask_issue,
+                save_jpg,
+                apply_cloud_mask,
+                max_cloud_no_data_cover,
+            )
+            for i, im_meta in [(i, im_list[i]) for i in idx_new]
+        ]
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc=f"{inputs['sitename']}: Downloading Imagery for {satname}",
+            position=position,
+            leave=True,
+        ):
+            result = future.result()
+            if result is not None:
+                # write the metadata of each image as soon as it is downloaded, so that it
+                # is not lost with the images already on disk if the run is interrupted
+                filename_txt, metadict, image_id = result
+                if metadict is not None:
+                    write_metadata_files(filepaths[0], [(filename_txt, metadict, image_id)])
+                else:
+                    append_metadata_index(sat_folder, [{"id": image_id, "skipped": filters}])
+
+
 def retrieve_images(
     inputs,
     cloud_threshold: float = 0.95,
@@ -753,8 +1539,8 @@ def retrieve_images(
         os.makedirs(im_folder)
     # Initialize the logger
     logger = setup_logger(im_folder)
-    # initialise connection with GEE server
-    ee.Initialize()
+    # initialise connection with GEE server (high-volume endpoint for the pixel requests)
+    ee.Initialize(opt_url="https://earthengine-highvolume.googleapis.com")
     
     # validates the inputs have references the correct collection (C02)
     inputs = validate_collection(inputs)
@@ -766,6 +1552,7 @@ def retrieve_images(
     im_dict_T1 = merge_image_tiers(inputs, im_dict_T1, im_dict_T2)
 
     # remove UTM duplicates in S2 collections (they provide several projections for same images)
+    im_dict_s2cloudless = []
     if "S2" in inputs["sat_list"] and len(im_dict_T1["S2"]) > 0:
         im_dict_T1["S2"] = filter_S2_collection(im_dict_T1["S2"])
         # get s2cloudless collection
@@ -797,580 +1584,152 @@ def retrieve_images(
         print(f"{inputs['sitename']}: No images to download for {sat_list} during {dates} for {cloud_threshold}% cloud cover")
     else:     
         # main loop to download the images for each satellite mission
-        # print('\nDownloading images:')
-        suffix = ".tif"
-        count = 1
+        # the satellite missions are downloaded concurrently (disjoint folders and collections),
+        # the number of requests sent to GEE is bounded globally in download_tif
         num_satellites = len(im_dict_T1.keys())
-        for satname in tqdm(
-            im_dict_T1.keys(), desc=f"{inputs['sitename']}: Downloading Imagery for {num_satellites} satellites"
-        ):
-            count += 1
-            # create subfolder structure to store the different bands
-            filepaths = SDS_tools.create_folder_structure(im_folder, satname)
-            # initialise variables and loop through images
-            bands_id = bands_dict[satname]
-            all_names = []  # list for detecting duplicates
-            if len(im_dict_T1[satname]) == 0:
-                print(f"{inputs['sitename']}: No images to download for {satname}")
-                continue
-            # loop through each image
-            pbar = tqdm(
-                range(len(im_dict_T1[satname])),
-                desc=f"{inputs['sitename']}: Downloading Imagery for {satname}",
-                leave=True,
+        with ThreadPoolExecutor(max_workers=num_satellites) as executor:
+            futures = [
+                executor.submit(
+                    _download_satellite,
+                    satname,
+                    im_dict_T1[satname],
+                    im_dict_s2cloudless if satname == "S2" else [],
+                    inputs,
+                    im_folder,
+                    bands_dict[satname],
+                    logger,
+                    position + 1,
+                    cloud_threshold,
+                    cloud_mask_issue,
+                    save_jpg,
+                    apply_cloud_mask,
+                    max_cloud_no_data_cover,
+                )
+                for position, satname in enumerate(im_dict_T1.keys())
+            ]
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc=f"{inputs['sitename']}: Downloading Imagery for {num_satellites} satellites",
+                position=0,
+            ):
+                future.result()
+    # once all images have been downloaded, load metadata from .txt files
+    # (get_metadata also saves the metadata dict in the metadata json of the site)
+    metadata = get_metadata(inputs)
+    print("Satellite images downloaded from GEE and save in %s" % im_folder)
+    return metadata
+
+
+def write_metadata_files(filepath_meta: str, meta_rows: list) -> None:
+    """
+    Writes the metadata of downloaded images of a satellite: a .txt file per image
+    in the meta folder and one line per image appended to metadata.ndjson in the
+    satellite folder (see read_metadata_index).
+
+    Arguments:
+    -----------
+    filepath_meta: str
+        path to the meta folder of the satellite
+    meta_rows: list of tuples
+        (filename_txt, metadict, image_id) returned by _process_one_image
+
+    Returns:
+    -----------
+    None
+    """
+    if len(meta_rows) == 0:
+        return
+    rows = []
+    for filename_txt, metadict, image_id in meta_rows:
+        fn_txt = os.path.join(filepath_meta, filename_txt + ".txt")
+        with open(fn_txt, "w") as f:
+            f.write("".join("%s\t%s\n" % (key, metadict[key]) for key in metadict))
+        # the stat of the .txt file is stored to detect a later modification of the file
+        stat = os.stat(fn_txt)
+        rows.append(
+            dict(
+                metadict,
+                txt=filename_txt + ".txt",
+                id=image_id,
+                mtime_ns=stat.st_mtime_ns,
+                size=stat.st_size,
             )
-            for i in pbar:
-                try:
-                    # initalize the variables
-                    # filepath (fp) for the multispectural file
-                    fp_ms = ""
-                    # store the bands availble
-                    bands = dict([])
-                    # dictionary containing the filepaths for each type of file downloaded
-                    im_fn = dict([])
-
-                    # get image metadata
-                    im_meta = im_dict_T1[satname][i]
-
-                    # get time of acquisition (UNIX time) and convert to datetime
-                    acquisition_time = im_meta["properties"]["system:time_start"]
-                    im_timestamp = datetime.fromtimestamp(
-                        acquisition_time / 1000, tz=pytz.utc
-                    )
-                    im_date = im_timestamp.strftime("%Y-%m-%d-%H-%M-%S")
-
-                    # get epsg code
-                    im_epsg = int(im_meta["bands"][0]["crs"][5:])
-
-                    # get quality flags (geometric and radiometric quality)
-                    accuracy_georef = get_georeference_accuracy(satname, im_meta)
-                    image_quality = get_image_quality(satname, im_meta)
-
-                    # select image by id
-                    image_ee = ee.Image(im_meta["id"])
-                    # for S2 add s2cloudless probability band
-                    if satname == "S2":
-                        if len(im_dict_s2cloudless[i]) == 0:
-                            raise Exception(
-                                "could not find matching s2cloudless image, raise issue on Github at"
-                                + "https://github.com/kvos/CoastSat/issues and provide your inputs."
-                            )
-                        im_cloud = ee.Image(im_dict_s2cloudless[i]["id"])
-                        cloud_prob = im_cloud.select("probability").rename("s2cloudless")
-                        image_ee = image_ee.addBands(cloud_prob)
-
-                    # update the loading bar with the status
-                    pbar.set_description_str(
-                        desc=f"{inputs['sitename']}, {satname}: Loading bands for {SDS_tools.ordinal(i)} image ", refresh=True
-                    )
-                    # first delete dimensions key from dictionary
-                    # otherwise the entire image is extracted (don't know why)
-                    im_bands = remove_dimensions_from_bands(
-                        image_ee, image_id=im_meta["id"], logger=logger
-                    )
+        )
+    # metadata.ndjson sits next to the meta folder so that get_metadata only sees .txt files
+    append_metadata_index(os.path.dirname(filepath_meta), rows)
 
-                    # =============================================================================================#
-                    # Landsat 5 download
-                    # =============================================================================================#
-                    if satname == "L5":
-                        fp_ms = filepaths[1]
-                        fp_mask = filepaths[2]
-                        # select multispectral bands
-                        bands["ms"] = [
-                            im_bands[_]
-                            for _ in range(len(im_bands))
-                            if im_bands[_]["id"] in bands_id
-                        ]
-                        # adjust polygon to match image coordinates so that there is no resampling
-                        proj = image_ee.select("B1").projection()
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: adjusting polygon {SDS_tools.ordinal(i)} image ", refresh=True
-                        )
-                        ee_region = adjust_polygon(
-                            inputs["polygon"], proj, image_id=im_meta["id"], logger=logger
-                        )
-                        # download .tif from EE (one file with ms bands and one file with QA band)
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: Downloading tif for {SDS_tools.ordinal(i)} image ",
-                            refresh=True,
-                        )
-                        fn_ms, fn_QA = download_tif(
-                            image_ee,
-                            ee_region,
-                            bands["ms"],
-                            fp_ms,
-                            satname,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        # create filename for image
-                        for key in bands.keys():
-                            im_fn[key] = (
-                                im_date
-                                + "_"
-                                + satname
-                                + "_"
-                                + inputs["sitename"]
-                                + "_"
-                                + key
-                                + suffix
-                            )
-                        # if multiple images taken at the same date add 'dupX' to the name (duplicate number X)
-                        im_fn = handle_duplicate_image_names(
-                            all_names,
-                            bands,
-                            im_fn,
-                            im_date,
-                            satname,
-                            inputs["sitename"],
-                            suffix,
-                        )
-                        im_fn["mask"] = im_fn["ms"].replace("_ms", "_mask")
-                        filename_ms = im_fn["ms"]
-                        all_names.append(im_fn["ms"])
-
-                        # resample ms bands to 15m with bilinear interpolation
-                        fn_in = fn_ms
-                        fn_target = fn_ms
-                        fn_out = os.path.join(fp_ms, im_fn["ms"])
-                        filepath_ms = os.path.join(fp_ms, im_fn["ms"])
-                        
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: Transforming {SDS_tools.ordinal(i)} image ", refresh=True
-                        )
-                        warp_image_to_target(
-                            fn_in,
-                            fn_out,
-                            fn_target,
-                            double_res=True,
-                            resampling_method="bilinear",
-                        )
 
-                        # resample QA band to 15m with nearest-neighbour interpolation
-                        fn_in = fn_QA
-                        fn_target = fn_QA
-                        fn_out = os.path.join(fp_mask, im_fn["mask"])
-                        filepath_QA = os.path.join(fp_mask, im_fn["mask"])
-                        
-                        warp_image_to_target(
-                            fn_in,
-                            fn_out,
-                            fn_target,
-                            double_res=True,
-                            resampling_method="near",
-                        )
-                        # delete original downloads
-                        for original_file in [fn_ms, fn_QA]:
-                            os.remove(original_file)
-                            
-        
-                        fn = [filepath_ms,filepath_QA]
-                        skip_image=SDS_preprocess.filter_images_by_cloud_cover_nodata(fn,satname, cloud_mask_issue,max_cloud_no_data_cover,cloud_threshold,  do_cloud_mask=True, s2cloudless_prob=60)
-                        # if the images was filtered out, skip the image being saved as a jpg
-                        if skip_image:
-                            continue                        
-                            
-                        if save_jpg:
-                            # location of the tif folder for that satellite
-                            # For ex. S2 contains 2 tif folders /ms /swir /mask
-                            tif_paths = SDS_tools.get_filepath(inputs, satname)
-                            SDS_preprocess.save_single_jpg(
-                                filename=im_fn["ms"],
-                                tif_paths=tif_paths,
-                                satname=satname,
-                                sitename=inputs["sitename"],
-                                cloud_thresh=cloud_threshold,
-                                cloud_mask_issue=cloud_mask_issue,
-                                filepath_data=inputs["filepath"],
-                                collection=inputs["landsat_collection"],
-                                apply_cloud_mask=apply_cloud_mask,
-                            )
-
-                    # =============================================================================================#
-                    # Landsat 7, 8 and 9 download
-                    # =============================================================================================#
-                    elif satname in ["L7", "L8", "L9"]:
-                        fp_ms = filepaths[1]
-                        fp_pan = filepaths[2]
-                        fp_mask = filepaths[3]
-                        # select bands (multispectral and panchromatic)
-                        bands["ms"] = [
-                            im_bands[_]
-                            for _ in range(len(im_bands))
-                            if im_bands[_]["id"] in bands_id
-                        ]
-                        bands["pan"] = [
-                            im_bands[_]
-                            for _ in range(len(im_bands))
-                            if im_bands[_]["id"] in ["B8"]
-                        ]
-                        # adjust polygon for both ms and pan bands
-                        proj_ms = image_ee.select("B1").projection()
-                        proj_pan = image_ee.select("B8").projection()
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: adjusting polygon {SDS_tools.ordinal(i)} image ", refresh=True
-                        )
-                        ee_region_ms = adjust_polygon(
-                            inputs["polygon"],
-                            proj_ms,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        ee_region_pan = adjust_polygon(
-                            inputs["polygon"],
-                            proj_pan,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
+def get_filter_params(cloud_threshold, cloud_mask_issue, max_cloud_no_data_cover) -> dict:
+    # arguments of retrieve_images that decide if an image is filtered out by its cloud cover
+    return {
+        "cloud_threshold": cloud_threshold,
+        "cloud_mask_issue": cloud_mask_issue,
+        "max_cloud_no_data_cover": max_cloud_no_data_cover,
+    }
 
-                        # download both ms and pan bands from EE
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: Downloading tif for {SDS_tools.ordinal(i)} image ",
-                            refresh=True,
-                        )
-                        fn_ms, fn_QA = download_tif(
-                            image_ee,
-                            ee_region_ms,
-                            bands["ms"],
-                            fp_ms,
-                            satname,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        fn_pan = download_tif(
-                            image_ee,
-                            ee_region_pan,
-                            bands["pan"],
-                            fp_pan,
-                            satname,
-                            image_id=im_meta["id"],
-                        )
-                        # create filename for both images (ms and pan)
-                        for key in bands.keys():
-                            im_fn[key] = (
-                                im_date
-                                + "_"
-                                + satname
-                                + "_"
-                                + inputs["sitename"]
-                                + "_"
-                                + key
-                                + suffix
-                            )
-                        # if multiple images taken at the same date add 'dupX' to the name (duplicate number X)
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: remove duplicates for {SDS_tools.ordinal(i)} image ",
-                            refresh=True,
-                        )
-                        im_fn = handle_duplicate_image_names(
-                            all_names,
-                            bands,
-                            im_fn,
-                            im_date,
-                            satname,
-                            inputs["sitename"],
-                            suffix,
-                        )
-                        im_fn["mask"] = im_fn["ms"].replace("_ms", "_mask")
-                        filename_ms = im_fn["ms"]
-                        all_names.append(im_fn["ms"])
-
-                        # resample the ms bands to the pan band with bilinear interpolation (for pan-sharpening later)
-                        fn_in = fn_ms
-                        fn_target = fn_pan
-                        fn_out = os.path.join(fp_ms, im_fn["ms"])
-                        filepath_ms = os.path.join(fp_ms, im_fn["ms"])
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: Transforming {SDS_tools.ordinal(i)} image ", refresh=True
-                        )
-                        warp_image_to_target(
-                            fn_in,
-                            fn_out,
-                            fn_target,
-                            double_res=False,
-                            resampling_method="bilinear",
-                        )
 
-                        # resample QA band to the pan band with nearest-neighbour interpolation
-                        fn_in = fn_QA
-                        fn_target = fn_pan
-                        fn_out = os.path.join(fp_mask, im_fn["mask"])
-                        filepath_QA = os.path.join(fp_mask, im_fn["mask"])
-                        warp_image_to_target(
-                            fn_in,
-                            fn_out,
-                            fn_target,
-                            double_res=False,
-                            resampling_method="near",
-                        )
+def parse_date_from_filename(filename: str) -> datetime:
+    # filenames start with the acquisition date in UTC, e.g. 2019-01-01-10-30-15_S2_...
+    return _parse_date_str(filename[:19])
 
-                        # rename pan band
-                        try:
-                            os.rename(fn_pan, os.path.join(fp_pan, im_fn["pan"]))
-                        except:
-                            os.remove(os.path.join(fp_pan, im_fn["pan"]))
-                            os.rename(fn_pan, os.path.join(fp_pan, im_fn["pan"]))
-                        # delete original downloads
-                        for _ in [fn_ms, fn_QA]:
-                            os.remove(_)
-
-                        filepath_pan = os.path.join(fp_pan, im_fn["pan"])
-                        fn = [filepath_ms,filepath_pan,filepath_QA]
-                        skip_image=SDS_preprocess.filter_images_by_cloud_cover_nodata(fn,satname, cloud_mask_issue,max_cloud_no_data_cover,cloud_threshold,  do_cloud_mask=True, s2cloudless_prob=60)
-                    
-                        # if the images was filtered out, skip the image being saved as a jpg
-                        if skip_image:
-                            continue
-
-                        if save_jpg:
-                            tif_paths = SDS_tools.get_filepath(inputs, satname)
-                            SDS_preprocess.save_single_jpg(
-                                filename=im_fn["ms"],
-                                tif_paths=tif_paths,
-                                satname=satname,
-                                sitename=inputs["sitename"],
-                                cloud_thresh=cloud_threshold,
-                                cloud_mask_issue=cloud_mask_issue,
-                                filepath_data=inputs["filepath"],
-                                collection=inputs["landsat_collection"],
-                                apply_cloud_mask=apply_cloud_mask,
-                            )
-
-                    # =============================================================================================#
-                    # Sentinel-2 download
-                    # =============================================================================================#
-                    elif satname in ["S2"]:
-                        fp_ms = filepaths[1]
-                        fp_swir = filepaths[2]
-                        fp_mask = filepaths[3]
-                        # select bands (10m ms RGB+NIR+s2cloudless, 20m SWIR1, 60m QA band)
-                        # Assuming bands_id is a predefined list, and im_bands is a predefined source list
-                        bands = {
-                            "ms": filter_bands(im_bands, bands_id[:5]),
-                            "swir": filter_bands(im_bands, bands_id[5:6]),
-                            "mask": filter_bands(im_bands, bands_id[-1:]),
-                        }
-                        # adjust polygon for both ms and pan bands
-                        # RGB and NIR bands 10m resolution and same footprint
-                        proj_ms = image_ee.select("B1").projection()
-                        # SWIR band 20m resolution and different footprint
-                        proj_swir = image_ee.select("B11").projection()
-                        proj_mask = image_ee.select("QA60").projection()
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: adjusting polygon {SDS_tools.ordinal(i)} image ", refresh=True
-                        )
-                        ee_region_ms = adjust_polygon(
-                            inputs["polygon"],
-                            proj_ms,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        ee_region_swir = adjust_polygon(
-                            inputs["polygon"],
-                            proj_swir,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        ee_region_mask = adjust_polygon(
-                            inputs["polygon"],
-                            proj_mask,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        # download the ms, swir and QA bands from EE
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: Downloading tif for {SDS_tools.ordinal(i)} image ",
-                            refresh=True,
-                        )
-                        fn_ms = download_tif(
-                            image_ee,
-                            ee_region_ms,
-                            bands["ms"],
-                            fp_ms,
-                            satname,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        fn_swir = download_tif(
-                            image_ee,
-                            ee_region_swir,
-                            bands["swir"],
-                            fp_swir,
-                            satname,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
-                        fn_QA = download_tif(
-                            image_ee,
-                            ee_region_mask,
-                            bands["mask"],
-                            fp_mask,
-                            satname,
-                            image_id=im_meta["id"],
-                            logger=logger,
-                        )
 
-                        # create filename for the three images (ms, swir and mask)
-                        for key in bands.keys():
-                            im_fn[key] = (
-                                im_date
-                                + "_"
-                                + satname
-                                + "_"
-                                + inputs["sitename"]
-                                + "_"
-                                + key
-                                + suffix
-                            )
-                        # if multiple images taken at the same date add 'dupX' to the name (duplicate)
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: remove duplicates for {SDS_tools.ordinal(i)} image ",
-                            refresh=True,
-                        )
-                        im_fn = handle_duplicate_image_names(
-                            all_names,
-                            bands,
-                            im_fn,
-                            im_date,
-                            satname,
-                            inputs["sitename"],
-                            suffix,
-                        )
-                        filename_ms = im_fn["ms"]
-                        all_names.append(im_fn["ms"])
-
-                        # resample the 20m swir band to the 10m ms band with bilinear interpolation
-                        fn_in = fn_swir
-                        fn_target = fn_ms
-                        fn_out = os.path.join(fp_swir, im_fn["swir"])
-                        filepath_swir = os.path.join(fp_swir, im_fn["swir"])
-                        pbar.set_description_str(
-                            desc=f"{inputs['sitename']}, {satname}: Transforming {SDS_tools.ordinal(i)} image ", refresh=True
-                        )
-                        warp_image_to_target(
-                            fn_in,
-                            fn_out,
-                            fn_target,
-                            double_res=False,
-                            resampling_method="bilinear",
-                        )
+@functools.lru_cache(maxsize=16384)
+def _parse_date_str(date_str: str) -> datetime:
+    # memoized as the same filenames are parsed again at every call of get_metadata
+    return datetime.strptime(date_str, "%Y-%m-%d-%H-%M-%S").replace(tzinfo=timezone.utc)
 
-                        # resample 60m QA band to the 10m ms band with nearest-neighbour interpolation
-                        fn_in = fn_QA
-                        fn_target = fn_ms
-                        fn_out = os.path.join(fp_mask, im_fn["mask"])
-                        filepath_QA = os.path.join(fp_mask, im_fn["mask"])
-                        warp_image_to_target(
-                            fn_in,
-                            fn_out,
-                            fn_target,
-                            double_res=False,
-                            resampling_method="near",
-                        )
 
-                        # delete original downloads
-                        for _ in [fn_swir, fn_QA]:
-                            os.remove(_)
-                        # rename the multispectral band file
-                        dst = os.path.join(fp_ms, im_fn["ms"])
-                        filepath_ms = os.path.join(fp_ms, im_fn["ms"])
-                        if not os.path.exists(dst):
-                            os.rename(fn_ms, dst)
-                            
-                        fn = [filepath_ms,filepath_swir,filepath_QA]
-                        
-                        # Removes images whose cloud cover and no data coverage exceeds the threshold
-                        skip_image=SDS_preprocess.filter_images_by_cloud_cover_nodata(fn,satname, cloud_mask_issue,max_cloud_no_data_cover,cloud_threshold,  do_cloud_mask=True, s2cloudless_prob=60)
-                        
-                        # if the images was filtered out, skip the image being saved as a jpg
-                        if skip_image:
-                            continue
-                        if save_jpg:
-                            tif_paths = SDS_tools.get_filepath(inputs, satname)
-                            SDS_preprocess.save_single_jpg(
-                                filename=im_fn["ms"],
-                                tif_paths=tif_paths,
-                                satname=satname,
-                                sitename=inputs["sitename"],
-                                cloud_thresh=cloud_threshold,
-                                cloud_mask_issue=cloud_mask_issue,
-                                filepath_data=inputs["filepath"],
-                                collection=inputs["landsat_collection"],
-                                apply_cloud_mask=apply_cloud_mask,
-                            )
-                except Exception as error:
-                    print(
-                        f"\nThe download for satellite {satname} image '{im_meta.get('id','unknown')}' failed due to {type(error).__name__ }"
-                    )
-                    print(error)
-                    logger.error(
-                        f"The download for satellite {satname} {im_meta.get('id','unknown')} failed due to \n {error} \n Traceback {traceback.format_exc()}"
-                    )
-                    continue
-                finally:
-                    try:
-                        # get image dimensions (width and height)
-                        if fp_ms:
-                            if im_fn.get("ms", "unknown") == "unknown":
-                                raise Exception(
-                                    f"Could not find ms band filename {im_meta.get('id','unknown')}"
-                                )
-                            image_path = os.path.join(fp_ms, im_fn.get("ms", "unknown"))
-
-                            width, height = SDS_tools.get_image_dimensions(image_path)
-                            # write metadata in a text file for easy access
-                            filename_txt = (
-                                im_fn["ms"].replace("_ms", "").replace(".tif", "")
-                            )
-                            metadict = {
-                                "filename": filename_ms,
-                                "epsg": im_epsg,
-                                "acc_georef": accuracy_georef,
-                                "image_quality": image_quality,
-                                "im_width": width,
-                                "im_height": height,
-                            }
-                            # no matter what attempt to write metadata
-                            with open(
-                                os.path.join(filepaths[0], filename_txt + ".txt"), "w"
-                            ) as f:
-                                for key in metadict.keys():
-                                    f.write("%s\t%s\n" % (key, metadict[key]))
-
-                            if im_fn.get("ms", "unknown") != "unknown":
-                                logger.info(
-                                    f"Successfully downloaded image id {im_meta.get('id','unknown')} as {im_fn.get('ms')}"
-                                )
-                    except Exception as e:
-                        # print(traceback.format_exc())
-                        logger.error(
-                            f"Could not save metasdata for {im_meta.get('id','unknown')} that failed.\n{e}"
-                        )
-                        continue
-    # once all images have been downloaded, load metadata from .txt files
-    metadata = get_metadata(inputs)
-    # save metadata dict
-    metadata_json = os.path.join(im_folder, inputs["sitename"] + "_metadata" + ".json")
-    SDS_preprocess.write_to_json(metadata_json, metadata)
-    print("Satellite images downloaded from GEE and save in %s" % im_folder)
-    return metadata
+def parse_dates_from_filenames(filenames: list) -> np.ndarray:
+    """
+    Vectorized version of parse_date_from_filename, converts the dates at the start
+    of the filenames into an array of naive UTC np.datetime64 (in seconds).
 
+    Arguments:
+    -----------
+    filenames: list of str
+        filenames starting with a date formatted as YYYY-MM-DD-HH-MM-SS
 
-def parse_date_from_filename(filename: str) -> datetime:
-    date_str = filename[0:19]
-    return pytz.utc.localize(
-        datetime(
-            int(date_str[:4]),
-            int(date_str[5:7]),
-            int(date_str[8:10]),
-            int(date_str[11:13]),
-            int(date_str[14:16]),
-            int(date_str[17:19]),
-        )
-    )
+    Returns:
+    -----------
+    dates: np.ndarray of datetime64[s]
+    """
+    # YYYY-MM-DD-HH-MM-SS -> YYYY-MM-DDTHH:MM:SS (ISO 8601) so numpy can parse it in C
+    dates_iso = [f[:10] + "T" + f[11:19].replace("-", ":") for f in filenames]
+    return np.array(dates_iso, dtype="datetime64[s]")
 
 
 def read_metadata_file(filepath: str) -> Dict[str, Union[str, int, float]]:
+    # the parsed file is cached, the modification time and size of the file are part of
+    # the cache key so that a modified file is read again
+    stat = os.stat(filepath)
+    return dict(_read_metadata_file_cached(filepath, stat.st_mtime_ns, stat.st_size))
+
+
+@functools.lru_cache(maxsize=16384)
+def _read_metadata_file_cached(
+    filepath: str, mtime_ns: int, size: int
+) -> Dict[str, Union[str, int, float]]:
+    items = []
+    with open(filepath, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue  # Skip empty lines
+
+            parts = line.split("\t")
+            if len(parts) < 2:
+                continue  # Skip lines without a tab character
+            items.append((parts[0], parts[1]))
+
+    return parse_metadata_items(items)
+
+
+def parse_metadata_items(items) -> Dict[str, Union[str, int, float]]:
+    """
+    Converts the (key, value) pairs of the metadata of an image (the lines of its .txt
+    file or a row of metadata.ndjson) into the metadata dictionary used by get_metadata.
+    """
     metadata_keys = [
         "filename",
         "epsg",
@@ -1393,48 +1752,136 @@ def read_metadata_file(filepath: str) -> Dict[str, Union[str, int, float]]:
         "im_height": -1,
     }
 
-    with open(filepath, "r") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue  # Skip empty lines
+    for key, value in items:
+        # values are parsed from their text form, as they were written in the .txt file
+        key = str(key).strip()
+        value = str(value).strip()
 
-            parts = line.split("\t")
-            if len(parts) < 2:
-                continue  # Skip lines without a tab character
-
-            key = parts[0].strip()
-            value = parts[1].strip()
-
-            # Map the actual key in the file to the metadata key
-            key = key_mapping.get(key, key)
+        # Map the actual key in the file to the metadata key
+        key = key_mapping.get(key, key)
 
-            # If the mapped key is not in metadata_keys, then skip it.
-            if key not in metadata_keys:
-                continue
+        # If the mapped key is not in metadata_keys, then skip it.
+        if key not in metadata_keys:
+            continue
 
-            # Convert value to the appropriate type based on the key
-            if key in ["epsg", "im_width", "im_height"]:
-                try:
-                    value = int(value)
-                except ValueError:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        print(
-                            f"Error: Unable to convert {key} {value} to a numeric value."
-                        )
-            elif key in ["acc_georef", "im_quality"]:
+        # Convert value to the appropriate type based on the key
+        if key in ["epsg", "im_width", "im_height"]:
+            try:
+                value = int(value)
+            except ValueError:
                 try:
                     value = float(value)
                 except ValueError:
-                    pass  # Keep the value as a string if conversion to float fails
+                    print(
+                        f"Error: Unable to convert {key} {value} to a numeric value."
+                    )
+        elif key in ["acc_georef", "im_quality"]:
+            try:
+                value = float(value)
+            except ValueError:
+                pass  # Keep the value as a string if conversion to float fails
 
-            # Update the metadata dictionary with the extracted key-value pair.
-            metadata[key] = value
+        # Update the metadata dictionary with the extracted key-value pair.
+        metadata[key] = value
 
     return metadata
 
+
+def read_metadata_index(sat_path: str) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+    """
+    Reads metadata.ndjson in the folder of a satellite mission, the record of the
+    images of the mission in a single file (one json object per line):
+    - an image with a .txt file in the meta folder: the metadata of the image, 'txt'
+    the name of the .txt file, 'mtime_ns' and 'size' of the .txt file when the row
+    was written and 'id' the GEE id of the image (None if unknown)
+    - an image filtered out by its cloud cover: 'id' and 'skipped', the filter
+    parameters (see get_filter_params)
+    - an image merged into or contained by another image: 'id' and 'skipped' set to
+    'merged' (see record_merged_images)
+    Later lines overwrite earlier ones.
+
+    Arguments:
+    -----------
+    sat_path: str
+        folder of the satellite mission
+
+    Returns:
+    -----------
+    rows: dict
+        metadata (as returned by read_metadata_file) of each image with the keys
+        'txt', 'id', 'mtime_ns' and 'size', by .txt filename
+    skipped: dict
+        filter parameters of each image filtered out (or 'merged'), by GEE id
+    Both are empty if the file does not exist or cannot be read.
+    """
+    fn_ndjson = os.path.join(sat_path, "metadata.ndjson")
+    try:
+        stat = os.stat(fn_ndjson)
+    except OSError:
+        return {}, {}
+    # the parsed file is cached (see read_metadata_file)
+    rows, skipped = _read_metadata_index_cached(fn_ndjson, stat.st_mtime_ns, stat.st_size)
+    return dict(rows), dict(skipped)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_metadata_index_cached(
+    fn_ndjson: str, mtime_ns: int, size: int
+) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+    rows, skipped = dict([]), dict([])
+    try:
+        with open(fn_ndjson, "r") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # empty line or line cut by an interrupted run
+                if not isinstance(row, dict):
+                    continue
+                if "txt" in row:
+                    rows[row["txt"]] = dict(
+                        parse_metadata_items(row.items()),
+                        txt=row["txt"],
+                        id=row.get("id"),
+                        mtime_ns=row.get("mtime_ns"),
+                        size=row.get("size"),
+                    )
+                elif "skipped" in row and "id" in row:
+                    skipped[row["id"]] = row["skipped"]
+    except OSError:
+        return {}, {}
+    return rows, skipped
+
+
+def append_metadata_index(sat_path: str, rows: List[dict]) -> None:
+    """
+    Appends rows (see read_metadata_index) to metadata.ndjson in the folder of a
+    satellite mission.
+    """
+    with open(os.path.join(sat_path, "metadata.ndjson"), "a+") as f:
+        # start on a new line if the last line was cut by an interrupted run
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        f.write("".join(json.dumps(row, default=str) + "\n" for row in rows))
+
+
+def write_metadata_index(sat_path: str, rows: Dict[str, dict], skipped: Dict[str, dict]) -> None:
+    """
+    Rewrites metadata.ndjson in the folder of a satellite mission from the rows of the
+    images and the filtered out images (see read_metadata_index), through a temporary
+    file so it is never left truncated.
+    """
+    fd, fn_tmp = tempfile.mkstemp(dir=sat_path, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        for row in rows.values():
+            f.write(json.dumps(row, default=str) + "\n")
+        for image_id, filters in skipped.items():
+            f.write(json.dumps({"id": image_id, "skipped": filters}, default=str) + "\n")
+    SDS_tools.set_default_permissions(fn_tmp)
+    os.replace(fn_tmp, os.path.join(sat_path, "metadata.ndjson"))
+
 def format_date(date_str: str) -> datetime:
     """
     Converts a date string to a datetime object in UTC timezone.
@@ -1469,8 +1916,10 @@ def format_date(date_str: str) -> datetime:
 
 def get_metadata(inputs):
     """
-    Gets the metadata from the downloaded images by parsing .txt files located
-    in the \meta subfolder.
+    Gets the metadata from the downloaded images listed by the .txt files located
+    in the \meta subfolder. The metadata is read from the metadata.ndjson file of
+    each satellite mission, the .txt files are only parsed if missing from it or
+    modified since (checked with their modification time and size).
 
     KV WRL 2018
     modified by Sharon Fitzpatrick 2023
@@ -1494,14 +1943,20 @@ def get_metadata(inputs):
     filepath = os.path.join(inputs["filepath"], inputs["sitename"])
     if not os.path.exists(filepath):
         raise FileNotFoundError(f"The directory {filepath} does not exist.")
+    # date range as naive UTC datetime64 to filter the filenames in one vectorized comparison
+    # (only needed if there are images to filter)
+    start_date, end_date = None, None
+    satellite_list = inputs.get("sat_list", ["L5", "L7", "L8", "L9", "S2"])
     # initialize metadata dict
     metadata = dict([])
     # loop through the satellite missions that were specified in the inputs
-    satellite_list = inputs.get("sat_list", ["L5", "L7", "L8", "L9", "S2"])
+    # folders of the site, listed once (scandir gives the type of the entries without a stat)
+    with os.scandir(filepath) as entries:
+        sat_folders = {entry.name for entry in entries if entry.is_dir()}
     for satname in satellite_list:
         sat_path = os.path.join(filepath, satname)
         # if a folder has been created for the given satellite mission
-        if satname in os.listdir(filepath):
+        if satname in sat_folders:
             # update the metadata dict
             metadata[satname] = {
                 "filenames": [],
@@ -1513,24 +1968,53 @@ def get_metadata(inputs):
             }
             # directory where the metadata .txt files are stored
             filepath_meta = os.path.join(sat_path, "meta")
-            # get the list of filenames and sort it chronologically
-            if not os.path.exists(filepath_meta):
+            # Get the list of filenames (with the stat of each file) and sort it chronologically
+            try:
+                with os.scandir(filepath_meta) as entries:
+                    stats = {
+                        entry.name: entry.stat()
+                        for entry in entries
+                        if entry.name.endswith(".txt")
+                    }
+            except FileNotFoundError:
                 continue
-            # Get the list of filenames and sort it chronologically
-            filenames_meta = sorted(os.listdir(filepath_meta))
-            # loop through the .txt files
-            for im_meta in filenames_meta:
+            filenames_meta = sorted(stats)
+            if len(filenames_meta) == 0:
+                continue
+            # the metadata of all the images is read from metadata.ndjson, the .txt files
+            # that are missing from it (images downloaded by an older version) or that were
+            # modified since their row was written are parsed again
+            rows, skipped = read_metadata_index(sat_path)
+            n_parsed = 0
+            for f in filenames_meta:
+                row = rows.get(f)
+                stat = (stats[f].st_mtime_ns, stats[f].st_size)
+                if row is None or (row["mtime_ns"], row["size"]) != stat:
+                    rows[f] = dict(
+                        read_metadata_file(os.path.join(filepath_meta, f)),
+                        txt=f,
+                        id=None if row is None else row["id"],
+                        mtime_ns=stat[0],
+                        size=stat[1],
+                    )
+                    n_parsed += 1
+            # rewrite metadata.ndjson if it does not match the .txt files (new or modified
+            # images, or images removed/merged since it was written)
+            if n_parsed > 0 or len(rows) != len(filenames_meta):
+                rows = {f: rows[f] for f in filenames_meta}
+                write_metadata_index(sat_path, rows, skipped)
+            # keep only the images inside the specified date range
+            if start_date is None:
                 if inputs.get("dates", None) is None:
                     raise ValueError("The 'dates' key is missing from the inputs.")
-                    
-                start_date = format_date(inputs['dates'][0])
-                end_date = format_date(inputs['dates'][1])
-                input_date = parse_date_from_filename(im_meta)
-                # if the image date is outside the specified date range, skip it
-                if input_date < start_date or input_date > end_date:
-                    continue
-                meta_filepath = os.path.join(filepath_meta, im_meta)
-                meta_info = read_metadata_file(meta_filepath)
+                start_date = np.datetime64(format_date(inputs["dates"][0]).replace(tzinfo=None), "s")
+                end_date = np.datetime64(format_date(inputs["dates"][1]).replace(tzinfo=None), "s")
+            im_dates = parse_dates_from_filenames(filenames_meta)
+            in_range = (im_dates >= start_date) & (im_dates <= end_date)
+            filenames_meta = [f for f, keep in zip(filenames_meta, in_range) if keep]
+            # loop through the images
+            for im_meta in filenames_meta:
+                meta_info = rows[im_meta]
 
                 # Append meta info to the appropriate lists in the metadata dictionary
                 metadata[satname]["filenames"].append(meta_info["filename"])
@@ -1597,10 +2081,10 @@ def remove_existing_imagery(image_dict:dict, metadata:dict,sat_list:list[str])->
     """
     for satname in sat_list:
         if satname not in metadata:
-            avail_date_list = [datetime.fromtimestamp(image['properties']['system:time_start'] / 1000, tz=pytz.utc).replace( microsecond=0) for image in image_dict[satname]]
+            avail_date_list = [datetime.fromtimestamp(image['properties']['system:time_start'] / 1000, tz=timezone.utc).replace( microsecond=0) for image in image_dict[satname]]
             print(f'{satname}:There are {len(avail_date_list)} images available, 0 images already exist, {len(avail_date_list)} to download')
         if satname in metadata and metadata[satname]['dates']:
-            avail_date_list = [datetime.fromtimestamp(image['properties']['system:time_start'] / 1000, tz=pytz.utc).replace( microsecond=0) for image in image_dict[satname]]
+            avail_date_list = [datetime.fromtimestamp(image['properties']['system:time_start'] / 1000, tz=timezone.utc).replace( microsecond=0) for image in image_dict[satname]]
             if len(avail_date_list) == 0:
                 print(f'{satname}:There are {len(avail_date_list)} images available, {len(metadata[satname]["dates"])} images already exist, {len(avail_date_list)} to download')
                 continue
@@ -1686,12 +2170,14 @@ def remove_cloudy_images(im_list, satname, cloud_threshold=0.95,**kwargs):
         cloud_property = "CLOUD_COVER"
     elif satname in ["S2"]:
         cloud_property = "CLOUDY_PIXEL_PERCENTAGE"
-    cloud_cover = [_["properties"][cloud_property] for _ in im_list]
-    if np.any([_ > cloud_threshold for _ in cloud_cover]):
-        idx_delete = np.where([_ > cloud_threshold for _ in cloud_cover])[0]
-        im_list_upt = [x for k, x in enumerate(im_list) if k not in idx_delete]
-    else:
-        im_list_upt = im_list
+    # single pass over the images to read the cloud cover, then a vectorised comparison
+    # and a C-level filter keeping the images below the threshold
+    cloud_cover = np.fromiter(
+        (_["properties"][cloud_property] for _ in im_list),
+        dtype=np.float64,
+        count=len(im_list),
+    )
+    im_list_upt = list(compress(im_list, cloud_cover <= cloud_threshold))
 
     return im_list_upt
 
@@ -1714,46 +2200,100 @@ def adjust_polygon(polygon, proj, **kwargs):
         polygon = [[[151.3, -33.7],[151.4, -33.7],[151.4, -33.8],[151.3, -33.8],
         [151.3, -33.7]]]
         ```
-    proj: ee.Proj
-        projection of the underlying tile
+    proj: dict
+        projection of the underlying tile, as returned by
+        `image.select(band).projection().getInfo()` (keys 'crs' and 'transform')
 
     Returns:
     -----------
-    ee_region: ee
-        updated list of images
+    rect: list
+        [xmin, ymin, xmax, ymax] pixel coordinates of the ROI in the projection
+        of the tile, rounded to the closest pixels
     """
+    # the images of a same tile share their projection, so the rectangle is only
+    # requested once per projection
+    return list(
+        _adjust_polygon_cached(
+            json.dumps(polygon), proj["crs"], tuple(proj["transform"])
+        )
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _adjust_polygon_cached(polygon_json: str, crs: str, transform: tuple) -> tuple:
     # adjust polygon to match image coordinates so that there is no resampling
-    polygon_ee = ee.Geometry.Polygon(polygon)
+    polygon_ee = ee.Geometry.Polygon(json.loads(polygon_json))
+    proj_ee = ee.Projection(crs, list(transform))
     # convert polygon to image coordinates
-    polygon_coords = np.array(
-        ee.List(polygon_ee.transform(proj, 1).coordinates().get(0)).getInfo()
+    polygon_coords = ee.Array(
+        ee.List(polygon_ee.transform(proj_ee, 1).coordinates().get(0))
     )
-    # make it a rectangle
-    xmin = np.min(polygon_coords[:, 0])
-    ymin = np.min(polygon_coords[:, 1])
-    xmax = np.max(polygon_coords[:, 0])
-    ymax = np.max(polygon_coords[:, 1])
-    # round to the closest pixels
-    rect = [np.floor(xmin), np.floor(ymin), np.ceil(xmax), np.ceil(ymax)]
-    # convert back to epsg 4326
-    ee_region = ee.Geometry.Rectangle(rect, proj, True, False).transform("EPSG:4326")
-    return ee_region
+    # make it a rectangle rounded to the closest pixels on the server, so that
+    # only the 4 bounds are sent back
+    mins = polygon_coords.reduce(ee.Reducer.min(), [0]).floor()
+    maxs = polygon_coords.reduce(ee.Reducer.max(), [0]).ceil()
+    (xmin, ymin), (xmax, ymax) = [_[0] for _ in ee_get_info(ee.List([mins, maxs]))]
+    return (xmin, ymin, xmax, ymax)
+
+
+def get_pixel_grid(rect, proj, band):
+    """
+    Creates the pixel grid used by ee.data.computePixels to download a band over
+    the ROI, without any resampling of the band.
+
+    Arguments:
+    -----------
+    rect: list
+        [xmin, ymin, xmax, ymax] pixel coordinates of the ROI in the projection `proj`
+        (output of adjust_polygon)
+    proj: dict
+        projection in which `rect` is expressed (keys 'crs' and 'transform')
+    band: dict
+        metadata of the band to be downloaded (keys 'crs' and 'crs_transform')
+
+    Returns:
+    -----------
+    grid: dict
+        dimensions, affine transform and crs of the pixel grid
+    """
+    xmin, ymin, xmax, ymax = rect
+    transform = proj["transform"]
+    band_transform = band["crs_transform"]
+    # coordinates of the top-left corner of the ROI
+    x0 = transform[0] * xmin + transform[1] * ymin + transform[2]
+    y0 = transform[3] * xmin + transform[4] * ymin + transform[5]
+    # the band can have a finer resolution than the projection of the ROI (e.g. S2 B1 is 60m)
+    width = int(round((xmax - xmin) * transform[0] / band_transform[0]))
+    height = int(round((ymax - ymin) * transform[4] / band_transform[4]))
+    grid = {
+        "dimensions": {"width": width, "height": height},
+        "affineTransform": {
+            "scaleX": band_transform[0],
+            "shearX": band_transform[1],
+            "translateX": x0,
+            "shearY": band_transform[3],
+            "scaleY": band_transform[4],
+            "translateY": y0,
+        },
+        "crsCode": band["crs"],
+    }
+    return grid
 
 
 # decorator to try the download up to 3 times
 @retry
 def download_tif(
     image: ee.Image,
-    polygon: list,
+    grid: dict,
     bands: list[dict],
     filepath: str,
     satname: str,
     **kwargs,
 ) -> Union[str, Tuple[str, str]]:
     """
-    Downloads a .TIF image from the ee server. The image is downloaded as a
-    zip file then moved to the working directory, unzipped and stacked into a
-    single .TIF file. Any QA band is saved separately.
+    Downloads a .TIF image from the ee server. The pixels are requested with
+    ee.data.computePixels, which returns the bands stacked in a single GeoTIFF
+    (no download url and no zip file). Any QA band is saved separately.
 
     KV WRL 2018
 
@@ -1761,104 +2301,93 @@ def download_tif(
     -----------
     image: ee.Image
         Image object to be downloaded
-    polygon: list
-        polygon containing the lon/lat coordinates to be extracted
-        longitudes in the first column and latitudes in the second column
+    grid: dict
+        pixel grid of the ROI (output of get_pixel_grid)
     bands: list of dict
         list of bands to be downloaded
     filepath: str
         location where the temporary file should be saved
     satname: str
         name of the satellite missions ['L5','L7','L8','S2']
+    in_memory: bool (keyword, default False)
+        keep the .tif in GDAL's /vsimem/ in-memory filesystem instead of writing it
+        in filepath, for intermediate files that are only read by a warp
     Returns:
     -----------
-    Downloads an image in a file named data.tif
+    fn_image: str or tuple of str
+        filename of the .tif, for the Landsat multispectral bands the filenames
+        of the ms and QA .tif files (in GDAL's /vsimem/ in-memory filesystem)
 
     """
 
     # for the old version of ee raise an exception
-    if int(ee.__version__[-3:]) <= 201:
+    if _EE_TOO_OLD:
         raise Exception(
             "CoastSat2.0 and above is not compatible with earthengine-api version below 0.1.201."
             + "Try downloading a previous CoastSat version (1.x)."
         )
-    # for the newer versions of ee
+    band_ids = [band["id"] for band in bands]
+    # a GeoTIFF has a single data type (Landsat TOA bands are float, S2 bands are uint16)
+    if satname in ["L5", "L7", "L8", "L9"]:
+        expression = image.select(band_ids).toFloat()
     else:
-        # crop and download
-        download_id = ee.data.getDownloadId(
+        expression = image.select(band_ids).toUint16()
+    # crop and download
+    with EE_REQUEST_SEMAPHORE:
+        data = ee.data.computePixels(
             {
-                "image": image,
-                "region": polygon,
-                "bands": bands,
-                "filePerBand": True,
-                "name": "image",
+                "expression": expression,
+                "fileFormat": "GEO_TIFF",
+                "grid": grid,
             }
         )
-        response = requests.get(
-            ee.data.makeDownloadUrl(download_id),
-            timeout=(30, 30),  # 30 seconds to connect, 30 seconds to read
-        )
-        fp_zip = os.path.join(filepath, "temp.zip")
-        with open(fp_zip, "wb") as fd:
-            fd.write(response.content)
-        # unzip the individual bands
-        with zipfile.ZipFile(fp_zip) as local_zipfile:
-            for fn in local_zipfile.namelist():
-                local_zipfile.extract(fn, filepath)
-            fn_all = [os.path.join(filepath, _) for _ in local_zipfile.namelist()]
-        os.remove(fp_zip)
-        # now process the individual bands:
-        # - for Landsat
-        if satname in ["L5", "L7", "L8", "L9"]:
-            # if there is only one band, it's the panchromatic
-            if len(fn_all) == 1:
-                # return the filename of the .tif
-                return fn_all[0]
-            # otherwise there are multiple multispectral bands so we have to merge them into one .tif
-            else:
-                # select all ms bands except the QA band (which is processed separately)
-                fn_tifs = [_ for _ in fn_all if not "QA" in _]
-                filename = "ms_bands.tif"
-                # build a VRT and merge the bands (works the same with pan band)
-                outds = gdal.BuildVRT(
-                    os.path.join(filepath, "temp.vrt"), fn_tifs, separate=True
-                )
-                outds = gdal.Translate(os.path.join(filepath, filename), outds)
-                # remove temporary files
-                os.remove(os.path.join(filepath, "temp.vrt"))
-                for _ in fn_tifs:
-                    os.remove(_)
-                if os.path.exists(os.path.join(filepath, filename + ".aux.xml")):
-                    os.remove(os.path.join(filepath, filename + ".aux.xml"))
-                # return file names (ms and QA bands separately)
-                fn_image = os.path.join(filepath, filename)
-                fn_QA = [_ for _ in fn_all if "QA" in _][0]
-                return fn_image, fn_QA
-        # - for Sentinel-2
-        if satname in ["S2"]:
-            # if there is only one band, it's either the SWIR1 or QA60
-            if len(fn_all) == 1:
-                # return the filename of the .tif
-                return fn_all[0]
-            # otherwise there are multiple multispectral bands so we have to merge them into one .tif
-            else:
-                # select all ms bands except the QA band (which is processed separately)
-                fn_tifs = fn_all
-                filename = "ms_bands.tif"
-                # build a VRT and merge the bands (works the same with pan band)
-                outds = gdal.BuildVRT(
-                    os.path.join(filepath, "temp.vrt"), fn_tifs, separate=True
-                )
-                outds = gdal.Translate(os.path.join(filepath, filename), outds)
-                # remove temporary files
-                os.remove(os.path.join(filepath, "temp.vrt"))
-                for _ in fn_tifs:
-                    os.remove(_)
-                if os.path.exists(os.path.join(filepath, filename + ".aux.xml")):
-                    os.remove(os.path.join(filepath, filename + ".aux.xml"))
-                # return filename of the merge .tif file
-                fn_image = os.path.join(filepath, filename)
-                return fn_image
+    # name the temporary files after the image, several images are downloaded in parallel
+    prefix = os.path.basename(kwargs.get("image_id", satname))
+    # for Landsat the QA band is downloaded with the ms bands, save it in a separate .tif
+    if satname in ["L5", "L7", "L8", "L9"] and len(band_ids) > 1:
+        idx_ms = [k + 1 for k, band_id in enumerate(band_ids) if not "QA" in band_id]
+        idx_QA = [k + 1 for k, band_id in enumerate(band_ids) if "QA" in band_id]
+        # keep the downloaded GeoTIFF and the split ms and QA files in GDAL's in-memory
+        # filesystem, they are only read by the warp onto the final pixel grid
+        # (the names are unique per image and band group, remove them with remove_temporary_files)
+        fn_image = "/vsimem/%s_%s.tif" % (prefix, "_".join(band_ids))
+        fn_ms = fn_image.replace(".tif", "_ms_bands.tif")
+        fn_QA = fn_image.replace(".tif", "_QA_band.tif")
+        gdal.FileFromMemBuffer(fn_image, data)
+        # FileFromMemBuffer copies the buffer, release the response before splitting
+        # the bands so that only one copy of the download is held in memory
+        del data
+        try:
+            gdal.Translate(fn_ms, fn_image, bandList=idx_ms)
+            gdal.Translate(fn_QA, fn_image, bandList=idx_QA, outputType=gdal.GDT_UInt16)
+        finally:
+            gdal.Unlink(fn_image)
+        # return file names (ms and QA bands separately)
+        return fn_ms, fn_QA
+    # single band group, the response is written once to its .tif file
+    if kwargs.get("in_memory", False):
+        fn_image = "/vsimem/%s_%s.tif" % (prefix, "_".join(band_ids))
+        gdal.FileFromMemBuffer(fn_image, data)
+        return fn_image
+    fn_image = os.path.join(filepath, prefix + ".tif")
+    with open(fn_image, "wb") as fd:
+        fd.write(data)
+    # return filename of the .tif file
+    return fn_image
+
+
+def remove_temporary_files(filenames: List[str]) -> None:
+    """
+    Removes the temporary files of a download, from GDAL's in-memory filesystem
+    (/vsimem/) or from the disk, along with their .aux.xml sidecar if any.
+    """
+    for fn in filenames:
+        for fn_remove in [fn, fn + ".aux.xml"]:
+            if fn_remove.startswith("/vsimem/"):
+                if gdal.VSIStatL(fn_remove) is not None:
+                    gdal.Unlink(fn_remove)
+            elif os.path.exists(fn_remove):
+                os.remove(fn_remove)
 
 
 def warp_image_to_target(
@@ -1891,44 +2420,124 @@ def warp_image_to_target(
     Creates a new .tif file (fn_out)
 
     """
-    # get output extent from target image
+    # get output extent from target image (opened once, its georef and size are
+    # also used to check the output)
     im_target = gdal.Open(fn_target, gdal.GA_ReadOnly)
     georef_target = np.array(im_target.GetGeoTransform())
+    size_target = np.array([im_target.RasterXSize, im_target.RasterYSize])
+    im_target = None
     xres = georef_target[1]
     yres = georef_target[5]
     if double_res:
         xres = int(georef_target[1] / 2)
         yres = int(georef_target[5] / 2)
-    extent_pan = SDS_tools.get_image_bounds(fn_target)
-    extent_coords = np.array(extent_pan.exterior.coords)
-    xmin = np.min(extent_coords[:, 0])
-    ymin = np.min(extent_coords[:, 1])
-    xmax = np.max(extent_coords[:, 0])
-    ymax = np.max(extent_coords[:, 1])
-
+    # corners of the target image (same as SDS_tools.get_image_bounds)
+    px, py = np.meshgrid([0, size_target[0]], [0, size_target[1]])
+    extent_x = georef_target[0] + px * georef_target[1] + py * georef_target[2]
+    extent_y = georef_target[3] + px * georef_target[4] + py * georef_target[5]
+    xmin = np.min(extent_x)
+    ymin = np.min(extent_y)
+    xmax = np.max(extent_x)
+    ymax = np.max(extent_y)
+
+    # horizontal differencing predictor for integer bands (QA, S2), floating point one for TOA
+    im_in = gdal.Open(fn_in, gdal.GA_ReadOnly)
+    data_type = im_in.GetRasterBand(1).DataType
+    im_in = None
+    predictor = "3" if data_type in [gdal.GDT_Float32, gdal.GDT_Float64] else "2"
     # use gdal_warp to resample the input onto the target image pixel grid
+    # (in-process, multithreaded, with a lossless compression of the output .tif)
     options = gdal.WarpOptions(
+        format="GTiff",
         xRes=xres,
         yRes=yres,
         outputBounds=[xmin, ymin, xmax, ymax],
         resampleAlg=resampling_method,
         targetAlignedPixels=False,
+        multithread=True,
+        warpOptions=["NUM_THREADS=ALL_CPUS"],
+        creationOptions=[
+            "TILED=YES",
+            "COMPRESS=DEFLATE",
+            "PREDICTOR=" + predictor,
+            "NUM_THREADS=ALL_CPUS",
+        ],
     )
-    gdal.Warp(fn_out, fn_in, options=options)
+    # write to a temporary file, moved to fn_out once complete so that an interrupted
+    # run never leaves a truncated .tif behind
+    fn_part = fn_out + ".part"
+    try:
+        with WARP_SEMAPHORE:
+            gdal.Warp(fn_part, fn_in, options=options)
+
+        # check that both files have the same georef and size (important!)
+        im_out = gdal.Open(fn_part, gdal.GA_ReadOnly)
+        georef_out = np.array(im_out.GetGeoTransform())
+        size_out = np.array([im_out.RasterXSize, im_out.RasterYSize])
+        im_out = None
+        if double_res:
+            size_target = size_target * 2
+        if np.any(np.nonzero(georef_target[[0, 3]] - georef_out[[0, 3]])):
+            raise Exception("Georef of pan and ms bands do not match for image %s" % fn_out)
+        if np.any(np.nonzero(size_target - size_out)):
+            raise Exception("Size of pan and ms bands do not match for image %s" % fn_out)
+        os.replace(fn_part, fn_out)
+    finally:
+        if os.path.exists(fn_part):
+            os.remove(fn_part)
+
+
+def merge_rasters(fn_list, fn_out, nodata=0):
+    """
+    Mosaics images on the same pixel grid into a single image with gdal_warp (in-process,
+    like gdal_merge.py -n but without parsing a command line or an intermediate file).
+    The pixels equal to nodata are ignored, the valid pixels of the last images are
+    written over the ones of the first images. The images are streamed in chunks of
+    at most MERGE_MEMORY_LIMIT bytes aligned with the tiles of the output, so the
+    memory used does not depend on the size of the images.
 
-    # check that both files have the same georef and size (important!)
-    im_target = gdal.Open(fn_target, gdal.GA_ReadOnly)
-    im_out = gdal.Open(fn_out, gdal.GA_ReadOnly)
-    georef_target = np.array(im_target.GetGeoTransform())
-    georef_out = np.array(im_out.GetGeoTransform())
-    size_target = np.array([im_target.RasterXSize, im_target.RasterYSize])
-    size_out = np.array([im_out.RasterXSize, im_out.RasterYSize])
-    if double_res:
-        size_target = size_target * 2
-    if np.any(np.nonzero(georef_target[[0, 3]] - georef_out[[0, 3]])):
-        raise Exception("Georef of pan and ms bands do not match for image %s" % fn_out)
-    if np.any(np.nonzero(size_target - size_out)):
-        raise Exception("Size of pan and ms bands do not match for image %s" % fn_out)
+    Arguments:
+    -----------
+    fn_list: list of str
+        filepaths of the input images (.tif files), the first one gives the pixel size
+    fn_out: str
+        filepath of the output image (will be created)
+    nodata: int
+        value of the pixels to ignore in the input images
+
+    Returns:
+    -----------
+    Creates a new .tif file (fn_out)
+
+    """
+    im_first = gdal.Open(fn_list[0], gdal.GA_ReadOnly)
+    georef = im_first.GetGeoTransform()
+    data_type = im_first.GetRasterBand(1).DataType
+    im_first = None
+    predictor = "3" if data_type in [gdal.GDT_Float32, gdal.GDT_Float64] else "2"
+    options = gdal.WarpOptions(
+        format="GTiff",
+        xRes=georef[1],
+        yRes=abs(georef[5]),
+        srcNodata=nodata,
+        dstNodata=nodata,
+        resampleAlg="near",
+        multithread=True,
+        warpMemoryLimit=MERGE_MEMORY_LIMIT,
+        # chunks made of whole output tiles, each tile is compressed and written once
+        warpOptions=["NUM_THREADS=ALL_CPUS", "OPTIMIZE_SIZE=YES"],
+        creationOptions=[
+            "TILED=YES",
+            "COMPRESS=DEFLATE",
+            "PREDICTOR=" + predictor,
+            "NUM_THREADS=ALL_CPUS",
+        ],
+    )
+    with WARP_SEMAPHORE:
+        ds = gdal.Warp(fn_out, fn_list, options=options)
+    if ds is None:
+        raise Exception("Could not merge the images into %s" % fn_out)
+    ds = None
 
 
 ###################################################################################################
@@ -1956,52 +2565,207 @@ def filter_S2_collection(im_list):
     if not im_list:
         return im_list
 
-    # get datetimes
-    timestamps = [
-        datetime.fromtimestamp(_["properties"]["system:time_start"] / 1000, tz=pytz.utc)
-        for _ in im_list
-    ]
+    # get acquisition times (UNIX time in ms)
+    timestamps = np.fromiter(
+        (_["properties"]["system:time_start"] for _ in im_list),
+        dtype=np.int64,
+        count=len(im_list),
+    )
     # get utm zone projections
-    utm_zones = np.array([int(_["bands"][0]["crs"][5:]) for _ in im_list])
-    if len(np.unique(utm_zones)) == 1:
+    utm_zones = np.fromiter(
+        (int(_["bands"][0]["crs"][5:]) for _ in im_list),
+        dtype=np.int64,
+        count=len(im_list),
+    )
+    zones, counts = np.unique(utm_zones, return_counts=True)
+    if len(zones) == 1:
         return im_list
     else:
-        idx_max = np.argmax([np.sum(utm_zones == _) for _ in np.unique(utm_zones)])
-        utm_zone_selected = np.unique(utm_zones)[idx_max]
+        utm_zone_selected = zones[np.argmax(counts)]
+        same_utm = utm_zones == utm_zone_selected
         # find the images that were acquired at the same time but have different utm zones
-        idx_all = np.arange(0, len(im_list), 1)
-        idx_covered = np.ones(len(im_list)).astype(bool)
-        idx_delete = []
-        i = 0
-        while 1:
-            same_time = (
-                np.abs([(timestamps[i] - _).total_seconds() for _ in timestamps])
-                < 60 * 60 * 24
-            )
-            idx_same_time = np.where(same_time)[0]
-            same_utm = utm_zones == utm_zone_selected
-            # get indices that have the same time (less than 24h apart) but not the same utm zone
-            idx_temp = np.where(
-                [same_time[j] == True and same_utm[j] == False for j in idx_all]
-            )[0]
-            idx_keep = idx_same_time[[_ not in idx_temp for _ in idx_same_time]]
+        # the images within 24h of each timestamp are found by bisection in the sorted
+        # timestamps, so that each window only touches the images it contains
+        order = np.argsort(timestamps, kind="stable")
+        timestamps_sorted = timestamps[order]
+        window_start = np.searchsorted(timestamps_sorted, timestamps - 86_400_000, side="right")
+        window_end = np.searchsorted(timestamps_sorted, timestamps + 86_400_000, side="left")
+        idx_covered = np.zeros(len(im_list), dtype=bool)
+        idx_delete = np.zeros(len(im_list), dtype=bool)
+        for i in range(len(im_list)):
+            # the windows start at the first image (in the list order) not yet covered
+            if idx_covered[i]:
+                continue
+            # images less than 24h apart from image i, in the list order
+            same_time = np.sort(order[window_start[i] : window_end[i]])
+            # delete images that have the same time (less than 24h apart) but not the same utm zone
+            idx_delete[same_time[~same_utm[same_time]]] = True
             # if more than 2 images with same date and same utm, drop the last ones
-            if len(idx_keep) > 2:
-                idx_temp = np.append(idx_temp, idx_keep[-(len(idx_keep) - 2) :])
-            for j in idx_temp:
-                idx_delete.append(j)
-            idx_covered[idx_same_time] = False
-            if np.any(idx_covered):
-                i = np.where(idx_covered)[0][0]
-            else:
-                break
+            idx_keep = same_time[same_utm[same_time]]
+            idx_delete[idx_keep[2:]] = True
+            idx_covered[same_time] = True
         # update the collection by deleting all those images that have same timestamp
         # and different utm projection
-        im_list_flt = [x for k, x in enumerate(im_list) if k not in idx_delete]
+        im_list_flt = [x for x, delete in zip(im_list, idx_delete) if not delete]
 
     return im_list_flt
 
 
+def _safe_remove(filepath):
+    """
+    Removes a file. The file is only made writable (chmod) if the removal is not permitted,
+    instead of before every removal.
+    """
+    try:
+        os.remove(filepath)
+    except PermissionError:
+        os.chmod(filepath, 0o777)
+        os.remove(filepath)
+
+
+def local_variance(image, radius):
+    """
+    Calculates the variance of an image in a moving window of specified radius, as
+    the difference between the box mean of the squared image and the squared box mean
+    (separable uniform filters, constant cost per pixel). The image is mirrored at
+    its edges like in SDS_tools.image_std, the variance is NaN around NaN pixels.
+
+    Arguments:
+    -----------
+    image: np.array
+        2D array containing the pixel intensities of a single-band image
+    radius: int
+        radius defining the moving window, radius = 1 will produce a 3x3 window
+
+    Returns:
+    -----------
+    win_var: np.array
+        2D array containing the local variance of the image
+    """
+    image = image.astype(float)
+    size = 2 * radius + 1
+    win_mean = ndimage.uniform_filter(image, size, mode="mirror")
+    win_sqr_mean = ndimage.uniform_filter(image * image, size, mode="mirror")
+    return win_sqr_mean - win_mean * win_mean
+
+
+def low_std_mask(im_std, threshold=1e-6):
+    """
+    Returns the mask of the pixels with a standard deviation below threshold or NaN,
+    i.e. np.logical_or(im_std < threshold, np.isnan(im_std)) in a single pass over the
+    float array: NaN fails every comparison, so negating im_std >= threshold (in place)
+    also flags the NaN pixels.
+
+    Arguments:
+    -----------
+    im_std: np.array
+        2D array with the standard deviation of the image
+    threshold: float
+        standard deviation under which the pixels are masked
+
+    Returns:
+    -----------
+    mask: np.array
+        2D boolean array, True for the masked pixels
+    """
+    mask = np.greater_equal(im_std, threshold)
+    return np.logical_not(mask, out=mask)
+
+
+def dilate_square(mask, size=3):
+    """
+    Dilates a boolean mask with a square structuring element of odd size. The square
+    is separable, so it is applied as a vertical then a horizontal 1D maximum filter
+    (2*size operations per pixel instead of size**2, and the running maximum of
+    maximum_filter1d keeps the cost constant for larger sizes).
+
+    Arguments:
+    -----------
+    mask: np.array
+        2D boolean array
+    size: int
+        width of the square structuring element (odd)
+
+    Returns:
+    -----------
+    mask_dilated: np.array
+        dilated 2D boolean array
+    """
+    # filter the bytes of the mask as uint8 (same itemsize as bool), outside is False
+    im = np.ascontiguousarray(mask, dtype=bool).view(np.uint8)
+    im = ndimage.maximum_filter1d(im, size, axis=0, mode="constant", cval=0)
+    im = ndimage.maximum_filter1d(im, size, axis=1, mode="constant", cval=0)
+    return im.view(bool)
+
+
+def _fit_shape(mask, shape):
+    """
+    Resamples a boolean mask to a new shape with nearest-neighbour interpolation, by
+    picking its rows and columns at a regular stride (e.g. mask[::2, ::2] to go from
+    10m to 20m pixels) in a single indexing operation, without float intermediates.
+    """
+    rows = np.arange(shape[0]) * mask.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * mask.shape[1] // shape[1]
+    return mask[np.ix_(rows, cols)]
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_image_bounds_cached(fn):
+    # bounds of the .tif files visited several times by merge_overlapping_images (an image
+    # can be in several pairs), the cache is cleared at the end of each merge
+    return SDS_tools.get_image_bounds(fn)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_prepared_bounds_cached(fn):
+    # prepared geometry of the bounds, for the repeated contains tests of merge_overlapping_images
+    return prep(_get_image_bounds_cached(fn))
+
+
+def read_S2_merge_bands(fn):
+    """
+    Reads the bands of a Sentinel-2 image that are needed to mask the artefacts before
+    merging it with an overlapping image: the first 10m band, the 20m SWIR band and
+    the shape of the 60m QA band.
+
+    Arguments:
+    -----------
+    fn: list
+        paths to the 10m, 20m and 60m .tif files of the image
+
+    Returns:
+    -----------
+    im_band: np.array
+        2D array with the first 10m band (empty if the image is all zeros)
+    im_swir: np.array
+        2D array with the 20m SWIR band
+    shape_QA: tuple
+        (rows, columns) of the 60m QA band
+    """
+    im_ms = np.stack(SDS_preprocess.read_bands(fn[0], "S2"), 2) / 10000
+    if np.sum(im_ms) < 1:
+        return [], [], ()
+    im_band = np.ascontiguousarray(im_ms[:, :, 0])
+    del im_ms
+    im_swir = SDS_preprocess.read_bands(fn[1])[0] / 10000
+    data = gdal.Open(fn[2], gdal.GA_ReadOnly)
+    shape_QA = (data.RasterYSize, data.RasterXSize)
+    data = None
+    return im_band, im_swir, shape_QA
+
+
+def record_merged_images(sat_path: str, filenames_txt: List[str]) -> None:
+    """
+    Records in metadata.ndjson the GEE ids of the images whose files were removed by
+    merge_overlapping_images (merged into or contained by another image), as skipped
+    rows so that they are not downloaded again (see read_metadata_index).
+    """
+    rows, _ = read_metadata_index(sat_path)
+    ids = [rows[f]["id"] for f in filenames_txt if f in rows and rows[f]["id"] is not None]
+    if len(ids) > 0:
+        append_metadata_index(sat_path, [{"id": image_id, "skipped": "merged"} for image_id in ids])
+
+
 def merge_overlapping_images(metadata, inputs):
     """
     Merge simultaneous overlapping images that cover the area of interest.
@@ -2051,8 +2815,29 @@ def merge_overlapping_images(metadata, inputs):
     # only for Sentinel-2 at this stage (not sure if this is needed for Landsat images)
     sat = "S2"
     filepath = os.path.join(inputs["filepath"], inputs["sitename"])
-    filenames = metadata[sat]["filenames"]
+    # copy of the filenames, updated with the names of the merged images (the list of the
+    # input metadata is not modified)
+    filenames = list(metadata[sat]["filenames"])
     total_images = len(filenames)
+    # directories of the S2 files, the paths are then built by concatenation
+    folders = ["10m", "20m", "60m", "meta"]
+    p10, p20, p60, pmeta = [os.path.join(filepath, "S2", folder) + os.sep for folder in folders]
+    # with the older versions of the ee api the mask of the 20m band is computed from its own
+    # std instead of resampling the 10m mask (decided once, not for each image)
+    recompute_mask20 = _EE_TOO_OLD
+    # paths of the 3 .tif files + the .txt file of each image, built once per filename
+    # (an image can be in several pairs)
+    S2_paths = dict([])
+
+    def get_S2_paths(fn):
+        if fn not in S2_paths:
+            S2_paths[fn] = [
+                p10 + fn,
+                p20 + fn.replace("10m", "20m"),
+                p60 + fn.replace("10m", "60m"),
+                pmeta + fn.replace("_10m", "").replace(".tif", ".txt"),
+            ]
+        return S2_paths[fn]
 
     # nested function
     def duplicates_dict(lst):
@@ -2068,8 +2853,23 @@ def merge_overlapping_images(metadata, inputs):
     # {"S2-2029-2020": [0,1,2,3]}
     # {"duplicate_filename": [indices of duplicated files]"}
 
+    # names of the .txt files removed by the merge (merged into or contained by another
+    # image), their GEE ids are recorded in metadata.ndjson at the end
+    removed_txt = []
     total_removed_step1 = 0
+    # indices (in metadata[sat]) of the images removed in the first pass
+    removed_indices = set()
     if len(duplicates) > 0:
+        # list the files of the S2 folders once, {filename: full path} for each folder
+        files_S2 = dict([])
+        for folder in folders:
+            try:
+                with os.scandir(os.path.join(filepath, "S2", folder)) as entries:
+                    files_S2[folder] = {
+                        entry.name: entry.path for entry in entries if entry.is_file()
+                    }
+            except FileNotFoundError:
+                files_S2[folder] = dict([])
         # loop through each pair of duplicates and merge them
         for key in duplicates.keys():
             idx_dup = duplicates[key]
@@ -2077,34 +2877,26 @@ def merge_overlapping_images(metadata, inputs):
             fn_im, polygons, im_epsg = [], [], []
             for index in range(len(idx_dup)):
                 # image names
+                fn = filenames[idx_dup[index]]
+                names = [
+                    fn,
+                    fn.replace("10m", "20m"),
+                    fn.replace("10m", "60m"),
+                    fn.replace("_10m", "").replace(".tif", ".txt"),
+                ]
                 fn_im.append(
                     [
-                        os.path.join(filepath, "S2", "10m", filenames[idx_dup[index]]),
-                        os.path.join(
-                            filepath,
-                            "S2",
-                            "20m",
-                            filenames[idx_dup[index]].replace("10m", "20m"),
-                        ),
-                        os.path.join(
-                            filepath,
-                            "S2",
-                            "60m",
-                            filenames[idx_dup[index]].replace("10m", "60m"),
-                        ),
-                        os.path.join(
-                            filepath,
-                            "S2",
-                            "meta",
-                            filenames[idx_dup[index]]
-                            .replace("_10m", "")
-                            .replace(".tif", ".txt"),
-                        ),
+                        files_S2[folder].get(name, prefix + name)
+                        for folder, prefix, name in zip(folders, [p10, p20, p60, pmeta], names)
                     ]
                 )
+                # skip the missing images without trying to open them
+                if not fn in files_S2["10m"]:
+                    print(f"\n The file {fn_im[index][0]} did not exist")
+                    continue
                 try:
                     # bounding polygons
-                    polygons.append(SDS_tools.get_image_bounds(fn_im[index][0]))
+                    polygons.append(_get_image_bounds_cached(fn_im[index][0]))
                     im_epsg.append(metadata[sat]["epsg"][idx_dup[index]])
                 except AttributeError:
                     print(
@@ -2125,14 +2917,12 @@ def merge_overlapping_images(metadata, inputs):
             # find which images contain other images
             contain_bools_list = []
             for i, poly1 in enumerate(polygons):
-                contain_bools = []
-                for k, poly2 in enumerate(polygons):
-                    if k == i:
-                        contain_bools.append(True)
-                        # print('%d*: '%k+str(poly1.contains(poly2)))
-                    else:
-                        # print('%d: '%k+str(poly1.contains(poly2)))
-                        contain_bools.append(poly1.contains(poly2))
+                # prepare poly1 once for the repeated contains queries
+                poly1_prepared = prep(poly1)
+                contain_bools = [
+                    k == i or poly1_prepared.contains(poly2)
+                    for k, poly2 in enumerate(polygons)
+                ]
                 contain_bools_list.append(contain_bools)
             # look if one image contains all the others
             contain_all = [np.all(_) for _ in contain_bools_list]
@@ -2143,28 +2933,37 @@ def merge_overlapping_images(metadata, inputs):
                     # print('removed %s'%(fn_im[i][-1]))
                     # remove the 3 .tif files + the .txt file
                     for k in range(4):
-                        os.chmod(fn_im[i][k], 0o777)
-                        os.remove(fn_im[i][k])
+                        _safe_remove(fn_im[i][k])
+                    removed_txt.append(os.path.basename(fn_im[i][3]))
+                    removed_indices.add(idx_dup[i])
                     total_removed_step1 += 1
-        # load metadata again and update filenames
-        metadata = get_metadata(inputs)
-        filenames = metadata[sat]["filenames"]
+        # drop the removed images from the metadata (on a copy, the input dict is not modified)
+        # instead of loading all the metadata files again
+        metadata = dict(metadata)
+        metadata[sat] = {
+            key: [v for j, v in enumerate(values) if j not in removed_indices]
+            for key, values in metadata[sat].items()
+        }
+        filenames = list(metadata[sat]["filenames"])
 
     # find the pairs of images that are within 5 minutes of each other and merge them
     time_delta = 5 * 60  # 5 minutes in seconds
-    dates = metadata[sat]["dates"].copy()
+    # index of the acquisition times (sorted once), the images within 5 minutes of each
+    # image are found by bisection instead of comparing every pair of images
+    timestamps = np.array([_.timestamp() for _ in metadata[sat]["dates"]], dtype=float)
+    order = np.argsort(timestamps, kind="stable")
+    timestamps_sorted = timestamps[order]
+    window_start = np.searchsorted(timestamps_sorted, timestamps - time_delta, side="left")
+    window_end = np.searchsorted(timestamps_sorted, timestamps + time_delta, side="right")
     pairs = []
-    for i, date in enumerate(metadata[sat]["dates"]):
-        # dummy value so it does not match it again
-        dates[i] = pytz.utc.localize(datetime(1, 1, 1) + timedelta(days=i + 1))
-        # calculate time difference
-        time_diff = np.array([np.abs((date - _).total_seconds()) for _ in dates])
-        # find the matching times and add to pairs list
-        boolvec = time_diff <= time_delta
-        if np.sum(boolvec) == 0:
+    for i in range(len(timestamps)):
+        # pair each image with the first following image (in the list) acquired within 5 minutes
+        idx_match = order[window_start[i] : window_end[i]]
+        idx_match = idx_match[idx_match > i]
+        if len(idx_match) == 0:
             continue
         else:
-            idx_dup = np.where(boolvec)[0][0]
+            idx_dup = int(np.min(idx_match))
             pairs.append([i, idx_dup])
     total_merged_step2 = len(pairs)
     # because they could be triplicates in S2 images, adjust the pairs for consecutive merges
@@ -2173,251 +2972,200 @@ def merge_overlapping_images(metadata, inputs):
             pairs[i][0] = pairs[i - 1][0]
 
     # check also for quadruplicates and remove them
-    pair_first = [_[0] for _ in pairs]
+    # indices of the pairs starting with each image, in a single pass over the pairs
+    pair_occurrences = defaultdict(list)
+    for j, pair in enumerate(pairs):
+        pair_occurrences[pair[0]].append(j)
     idx_remove_pair = []
-    for idx in np.unique(pair_first):
-        # calculate the number of duplicates
-        n_duplicates = sum(pair_first == idx)
+    for idx_pairs in pair_occurrences.values():
         # if more than 3 duplicates, delete the other images so that a max of 3 duplicates are handled
-        if n_duplicates > 2:
-            for i in range(2, n_duplicates):
+        if len(idx_pairs) > 2:
+            for j in idx_pairs[2:]:
                 # remove the last image: 3 .tif files + the .txt file
-                idx_last = [pairs[_] for _ in np.where(pair_first == idx)[0]][i][-1]
-                fn_im = [
-                    os.path.join(filepath, "S2", "10m", filenames[idx_last]),
-                    os.path.join(
-                        filepath, "S2", "20m", filenames[idx_last].replace("10m", "20m")
-                    ),
-                    os.path.join(
-                        filepath, "S2", "60m", filenames[idx_last].replace("10m", "60m")
-                    ),
-                    os.path.join(
-                        filepath,
-                        "S2",
-                        "meta",
-                        filenames[idx_last].replace("_10m", "").replace(".tif", ".txt"),
-                    ),
-                ]
+                idx_last = pairs[j][-1]
+                fn_im = get_S2_paths(filenames[idx_last])
                 for k in range(4):
-                    os.chmod(fn_im[k], 0o777)
-                    os.remove(fn_im[k])
+                    _safe_remove(fn_im[k])
+                removed_txt.append(os.path.basename(fn_im[3]))
                 # store the index of the pair to remove it outside the loop
-                idx_remove_pair.append(np.where(pair_first == idx)[0][i])
+                idx_remove_pair.append(j)
     # remove quadruplicates from list of pairs
+    idx_remove_pair = set(idx_remove_pair)
     pairs = [i for j, i in enumerate(pairs) if j not in idx_remove_pair]
 
-    # for each pair of image, first check if one image completely contains the other
-    # in that case keep the larger image. Otherwise merge the two images.
+    # check if epsg are the same, the merge stops at the first pair with different epsg
+    # (checked before merging as the pairs are then processed in parallel)
     for i, pair in enumerate(pairs):
-        # get filenames of all the files corresponding to the each image in the pair
-        fn_im = []
-        for index in range(len(pair)):
-            fn_im.append(
-                [
-                    os.path.join(filepath, "S2", "10m", filenames[pair[index]]),
-                    os.path.join(
-                        filepath,
-                        "S2",
-                        "20m",
-                        filenames[pair[index]].replace("10m", "20m"),
-                    ),
-                    os.path.join(
-                        filepath,
-                        "S2",
-                        "60m",
-                        filenames[pair[index]].replace("10m", "60m"),
-                    ),
-                    os.path.join(
-                        filepath,
-                        "S2",
-                        "meta",
-                        filenames[pair[index]]
-                        .replace("_10m", "")
-                        .replace(".tif", ".txt"),
-                    ),
-                ]
-            )
-        # get polygon for first image
-        try:
-            polygon0 = SDS_tools.get_image_bounds(fn_im[0][0])
-            im_epsg0 = metadata[sat]["epsg"][pair[0]]
-        except AttributeError:
-            print("\n Error getting the TIF. Skipping this iteration of the loop")
-            continue
-        except FileNotFoundError:
-            print(f"\n The file {fn_im[index][0]} did not exist")
-            continue
-        # get polygon for second image
-        try:
-            polygon1 = SDS_tools.get_image_bounds(fn_im[1][0])
-            im_epsg1 = metadata[sat]["epsg"][pair[1]]
-        except AttributeError:
-            print("\n Error getting the TIF. Skipping this iteration of the loop")
-            continue
-        except FileNotFoundError:
-            print(f"\n The file {fn_im[index][0]} did not exist")
-            continue
-        # check if epsg are the same
-        if not im_epsg0 == im_epsg1:
+        if not metadata[sat]["epsg"][pair[0]] == metadata[sat]["epsg"][pair[1]]:
             print(
                 "WARNING: there was an error as two S2 images do not have the same epsg,"
                 + " please open an issue on Github at https://github.com/kvos/CoastSat/issues"
                 + " and include your script so we can find out what happened."
             )
+            pairs = pairs[:i]
             break
-        # check if one image contains the other one
-        if polygon0.contains(polygon1):
-            # if polygon0 contains polygon1, remove files for polygon1
-            for k in range(4):  # remove the 3 .tif files + the .txt file
-                os.chmod(fn_im[1][k], 0o777)
-                os.remove(fn_im[1][k])
-            # print('removed 1')
-            continue
-        elif polygon1.contains(polygon0):
-            # if polygon1 contains polygon0, remove image0
-            for k in range(4):  # remove the 3 .tif files + the .txt file
-                os.chmod(fn_im[0][k], 0o777)
-                os.remove(fn_im[0][k])
-            # print('removed 0')
-            # adjust the order in case of triplicates
-            if i + 1 < len(pairs):
-                if pairs[i + 1][0] == pair[0]:
-                    pairs[i + 1][0] = pairs[i][1]
-            continue
-        # otherwise merge the two images after masking the nodata values
-        else:
-            for index in range(len(pair)):
-                # read image
-                (
-                    im_ms,
-                    georef,
-                    cloud_mask,
-                    im_extra,
-                    im_QA,
-                    im_nodata,
-                ) = SDS_preprocess.preprocess_single(fn_im[index], sat, False, "C02")
-                # in Sentinel2 images close to the edge of the image there are some artefacts,
-                # that are squares with constant pixel intensities. They need to be masked in the
-                # raster (GEOTIFF). It can be done using the image standard deviation, which
-                # indicates values close to 0 for the artefacts.
-                if len(im_ms) > 0:
-                    # calculate image std for the first 10m band
-                    im_std = SDS_tools.image_std(im_ms[:, :, 0], 1)
-                    # convert to binary
-                    im_binary = np.logical_or(im_std < 1e-6, np.isnan(im_std))
-                    # dilate to fill the edges (which have high std)
-                    mask10 = morphology.dilation(im_binary, morphology.square(3))
-                    # mask the 10m .tif file (add no_data where mask is True)
-                    SDS_tools.mask_raster(fn_im[index][0], mask10)
-                    # now calculate the mask for the 20m band (SWIR1)
-                    # for the older version of the ee api calculate the image std again
-                    if int(ee.__version__[-3:]) <= 201:
-                        # calculate std to create another mask for the 20m band (SWIR1)
-                        im_std = SDS_tools.image_std(im_extra, 1)
-                        im_binary = np.logical_or(im_std < 1e-6, np.isnan(im_std))
-                        mask20 = morphology.dilation(im_binary, morphology.square(3))
-                    # for the newer versions just resample the mask for the 10m bands
+
+    # for each pair of image, first check if one image completely contains the other
+    # in that case keep the larger image. Otherwise merge the two images.
+    # The pairs sharing their first image (triplicates) are processed one after the other,
+    # the groups of pairs are independent from each other and processed in parallel.
+    def merge_pairs(idx_group):
+        # names of the merged images in this group, returned as (index, new name) to the
+        # main thread, which updates the filenames list, with the .txt files removed
+        new_names = dict([])
+        removed_txt_group = []
+        for pos, i in enumerate(idx_group):
+            pair = pairs[i]
+            # get filenames of all the files corresponding to the each image in the pair
+            fn_im = [get_S2_paths(new_names.get(_, filenames[_])) for _ in pair]
+            # get polygon for first image
+            try:
+                polygon0 = _get_image_bounds_cached(fn_im[0][0])
+            except AttributeError:
+                print("\n Error getting the TIF. Skipping this iteration of the loop")
+                continue
+            except FileNotFoundError:
+                print(f"\n The file {fn_im[0][0]} did not exist")
+                continue
+            # get polygon for second image
+            try:
+                polygon1 = _get_image_bounds_cached(fn_im[1][0])
+            except AttributeError:
+                print("\n Error getting the TIF. Skipping this iteration of the loop")
+                continue
+            except FileNotFoundError:
+                print(f"\n The file {fn_im[1][0]} did not exist")
+                continue
+            # check if one image contains the other one
+            # (prepared geometries, reused across the pairs sharing an image)
+            if _get_prepared_bounds_cached(fn_im[0][0]).contains(polygon1):
+                # if polygon0 contains polygon1, remove files for polygon1
+                for k in range(4):  # remove the 3 .tif files + the .txt file
+                    _safe_remove(fn_im[1][k])
+                removed_txt_group.append(os.path.basename(fn_im[1][3]))
+                # print('removed 1')
+                continue
+            elif _get_prepared_bounds_cached(fn_im[1][0]).contains(polygon0):
+                # if polygon1 contains polygon0, remove image0
+                for k in range(4):  # remove the 3 .tif files + the .txt file
+                    _safe_remove(fn_im[0][k])
+                removed_txt_group.append(os.path.basename(fn_im[0][3]))
+                # print('removed 0')
+                # adjust the order in case of triplicates
+                if pos + 1 < len(idx_group):
+                    if pairs[idx_group[pos + 1]][0] == pair[0]:
+                        pairs[idx_group[pos + 1]][0] = pair[1]
+                continue
+            # otherwise merge the two images after masking the nodata values
+            else:
+                for index in range(len(pair)):
+                    # read image
+                    im_band10, im_extra, shape_QA = read_S2_merge_bands(fn_im[index])
+                    # in Sentinel2 images close to the edge of the image there are some artefacts,
+                    # that are squares with constant pixel intensities. They need to be masked in the
+                    # raster (GEOTIFF). It can be done using the image standard deviation, which
+                    # indicates values close to 0 for the artefacts.
+                    if len(im_band10) > 0:
+                        # calculate the local variance of the first 10m band (3x3 window)
+                        im_var = local_variance(im_band10, 1)
+                        # convert to binary (std < 1e-6)
+                        im_binary = low_std_mask(im_var, 1e-12)
+                        # dilate to fill the edges (which have high std)
+                        mask10 = dilate_square(im_binary, 3)
+                        # mask the 10m .tif file (add no_data where mask is True)
+                        SDS_tools.mask_raster(fn_im[index][0], mask10)
+                        # now calculate the mask for the 20m band (SWIR1)
+                        # for the older version of the ee api calculate the image std again
+                        if recompute_mask20:
+                            # calculate std to create another mask for the 20m band (SWIR1)
+                            im_var = local_variance(im_extra, 1)
+                            im_binary = low_std_mask(im_var, 1e-12)
+                            mask20 = dilate_square(im_binary, 3)
+                        # for the newer versions just resample the mask for the 10m bands
+                        else:
+                            # create mask for the 20m band (SWIR1) by resampling the 10m one
+                            mask20 = _fit_shape(mask10, im_extra.shape)
+                        # mask the 20m .tif file (im_extra)
+                        SDS_tools.mask_raster(fn_im[index][1], mask20)
+                        # create a mask for the 60m QA band by resampling the 20m one
+                        mask60 = _fit_shape(mask20, shape_QA)
+                        # mask the 60m .tif file (im_QA)
+                        SDS_tools.mask_raster(fn_im[index][2], mask60)
+                        # make a figure for quality control/debugging
+                        # im_RGB = SDS_preprocess.rescale_image_intensity(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
+                        # fig,ax= plt.subplots(2,3,tight_layout=True)
+                        # ax[0,0].imshow(im_RGB)
+                        # ax[0,0].set_title('RGB original')
+                        # ax[1,0].imshow(mask10)
+                        # ax[1,0].set_title('Mask 10m')
+                        # ax[0,1].imshow(mask20)
+                        # ax[0,1].set_title('Mask 20m')
+                        # ax[1,1].imshow(mask60)
+                        # ax[1,1].set_title('Mask 60 m')
+                        # ax[0,2].imshow(im_QA)
+                        # ax[0,2].set_title('Im QA')
+                        # ax[1,2].imshow(im_nodata)
+                        # ax[1,2].set_title('Im nodata')
                     else:
-                        # create mask for the 20m band (SWIR1) by resampling the 10m one
-                        mask20 = ndimage.zoom(mask10, zoom=1 / 2, order=0)
-                        mask20 = transform.resize(
-                            mask20,
-                            im_extra.shape,
-                            mode="constant",
-                            order=0,
-                            preserve_range=True,
-                        )
-                        mask20 = mask20.astype(bool)
-                    # mask the 20m .tif file (im_extra)
-                    SDS_tools.mask_raster(fn_im[index][1], mask20)
-                    # create a mask for the 60m QA band by resampling the 20m one
-                    mask60 = ndimage.zoom(mask20, zoom=1 / 3, order=0)
-                    mask60 = transform.resize(
-                        mask60,
-                        im_QA.shape,
-                        mode="constant",
-                        order=0,
-                        preserve_range=True,
-                    )
-                    mask60 = mask60.astype(bool)
-                    # mask the 60m .tif file (im_QA)
-                    SDS_tools.mask_raster(fn_im[index][2], mask60)
-                    # make a figure for quality control/debugging
-                    # im_RGB = SDS_preprocess.rescale_image_intensity(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
-                    # fig,ax= plt.subplots(2,3,tight_layout=True)
-                    # ax[0,0].imshow(im_RGB)
-                    # ax[0,0].set_title('RGB original')
-                    # ax[1,0].imshow(mask10)
-                    # ax[1,0].set_title('Mask 10m')
-                    # ax[0,1].imshow(mask20)
-                    # ax[0,1].set_title('Mask 20m')
-                    # ax[1,1].imshow(mask60)
-                    # ax[1,1].set_title('Mask 60 m')
-                    # ax[0,2].imshow(im_QA)
-                    # ax[0,2].set_title('Im QA')
-                    # ax[1,2].imshow(im_nodata)
-                    # ax[1,2].set_title('Im nodata')
-                else:
-                    continue
+                        continue
 
-            # once all the pairs of .tif files have been masked with no_data, merge the using gdal_merge
-            fn_merged = os.path.join(filepath, "merged.tif")
-            for k in range(3):
-                # merge masked bands
-                gdal_merge.main(
-                    ["", "-o", fn_merged, "-n", "0", fn_im[0][k], fn_im[1][k]]
-                )
-                # remove old files
-                os.chmod(fn_im[0][k], 0o777)
-                os.remove(fn_im[0][k])
-                os.chmod(fn_im[1][k], 0o777)
-                os.remove(fn_im[1][k])
-                # rename new file
-                fn_new = fn_im[0][k].split(".")[0] + "_merged.tif"
-                os.chmod(fn_merged, 0o777)
-                os.rename(fn_merged, fn_new)
-
-            # open both metadata files
-            metadict0 = dict([])
-            with open(fn_im[0][3], "r") as f:
-                metadict0["filename"] = f.readline().split("\t")[1].replace("\n", "")
-                metadict0["acc_georef"] = float(
-                    f.readline().split("\t")[1].replace("\n", "")
-                )
-                metadict0["epsg"] = int(f.readline().split("\t")[1].replace("\n", ""))
-            metadict1 = dict([])
-            with open(fn_im[1][3], "r") as f:
-                metadict1["filename"] = f.readline().split("\t")[1].replace("\n", "")
-                metadict1["acc_georef"] = float(
-                    f.readline().split("\t")[1].replace("\n", "")
-                )
-                metadict1["epsg"] = int(f.readline().split("\t")[1].replace("\n", ""))
-            # check if both images have the same georef accuracy
-            if np.any(
-                np.array([metadict0["acc_georef"], metadict1["acc_georef"]]) == -1
-            ):
-                metadict0["georef"] = -1
-            # add new name
-            metadict0["filename"] = metadict0["filename"].split(".")[0] + "_merged.tif"
-            # remove the old metadata.txt files
-            os.chmod(fn_im[0][3], 0o777)
-            os.remove(fn_im[0][3])
-            os.chmod(fn_im[1][3], 0o777)
-            os.remove(fn_im[1][3])
-            # rewrite the .txt file with a new metadata file
-            fn_new = fn_im[0][3].split(".")[0] + "_merged.txt"
-            with open(fn_new, "w") as f:
-                for key in metadict0.keys():
-                    f.write("%s\t%s\n" % (key, metadict0[key]))
-
-            # update filenames list (in case there are triplicates)
-            filenames[pair[0]] = metadict0["filename"]
+                # once all the pairs of .tif files have been masked with no_data, merge them
+                for k in range(3):
+                    # merge masked bands directly into the new file
+                    fn_new = os.path.splitext(fn_im[0][k])[0] + "_merged.tif"
+                    merge_rasters([fn_im[0][k], fn_im[1][k]], fn_new, nodata=0)
+                    # remove old files
+                    _safe_remove(fn_im[0][k])
+                    _safe_remove(fn_im[1][k])
+
+                # read both metadata files (parsed by key and cached, see read_metadata_file)
+                meta_keys = ["filename", "acc_georef", "epsg"]
+                meta0 = read_metadata_file(fn_im[0][3])
+                meta1 = read_metadata_file(fn_im[1][3])
+                metadict0 = {key: meta0[key] for key in meta_keys}
+                metadict1 = {key: meta1[key] for key in meta_keys}
+                # check if both images have the same georef accuracy
+                if metadict0["acc_georef"] == -1 or metadict1["acc_georef"] == -1:
+                    metadict0["acc_georef"] = -1
+                # add new name
+                metadict0["filename"] = os.path.splitext(metadict0["filename"])[0] + "_merged.tif"
+                # remove the old metadata.txt files
+                _safe_remove(fn_im[0][3])
+                _safe_remove(fn_im[1][3])
+                removed_txt_group += [os.path.basename(fn_im[0][3]), os.path.basename(fn_im[1][3])]
+                # rewrite the .txt file with a new metadata file
+                fn_new = os.path.splitext(fn_im[0][3])[0] + "_merged.txt"
+                with open(fn_new, "w") as f:
+                    f.write("".join("%s\t%s\n" % (key, val) for key, val in metadict0.items()))
+
+                # update filenames list (in case there are triplicates)
+                new_names[pair[0]] = metadict0["filename"]
+
+        return list(new_names.items()), removed_txt_group
+
+    pair_groups = defaultdict(list)
+    for i, pair in enumerate(pairs):
+        pair_groups[pair[0]].append(i)
+    if len(pair_groups) > 0:
+        n_workers = min(os.cpu_count() or 1, len(pair_groups))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # consume the results so that the exceptions raised in the threads are raised here
+            for new_names, removed_txt_group in executor.map(merge_pairs, pair_groups.values()):
+                for idx, fn in new_names:
+                    filenames[idx] = fn
+                removed_txt += removed_txt_group
+
+    # the files were removed or merged, their bounds must not be reused
+    _get_image_bounds_cached.cache_clear()
+    _get_prepared_bounds_cached.cache_clear()
 
     print(
         "%d out of %d Sentinel-2 images were merged (overlapping or duplicate)"
         % (total_removed_step1 + total_merged_step2, total_images)
     )
 
+    # the merged images are not downloaded again by the next runs
+    record_merged_images(os.path.join(filepath, sat), removed_txt)
     # update the metadata dict
     metadata_updated = get_metadata(inputs)
 
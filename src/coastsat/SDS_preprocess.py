@@ -9,6 +9,7 @@ Author: Kilian Vos, Water Research Laboratory, University of New South Wales
 # load modules
 import os
 import json
+import tempfile
 import numpy as np
 import matplotlib.pyplot as plt
 import pdb
@@ -321,8 +322,18 @@ def to_file(data: dict, filepath: str) -> None:
                 new_obj = [array.tolist() for array in obj]
                 return new_obj
 
-    with open(filepath, "w") as fp:
-        json.dump(data, fp, cls=DateTimeEncoder)
+    # write to a temporary file first and then move it, so that an interrupted run
+    # never leaves a truncated json file behind
+    fd, fn_tmp = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp, cls=DateTimeEncoder)
+        # the json is an output, it keeps the permissions given by the umask
+        SDS_tools.set_default_permissions(fn_tmp)
+        os.replace(fn_tmp, filepath)
+    finally:
+        if os.path.exists(fn_tmp):
+            os.remove(fn_tmp)
 
 
 def read_bands(filename: str, satname: str = "") -> list:
@@ -1022,8 +1033,7 @@ def create_jpg(
     # create folders RGB, SWIR, and NIR to hold each type of image
     for ext in file_types:
         ext_filepath = filepath + os.sep + ext
-        if not os.path.exists(ext_filepath):
-            os.mkdir(ext_filepath)
+        os.makedirs(ext_filepath, exist_ok=True)
         # location to save image ex. rgb image would be in sitename/RGB/sitename.jpg
         fname = os.path.join(ext_filepath, date + "_" + ext + "_" + satname + ".jpg")
         if ext == "RGB":
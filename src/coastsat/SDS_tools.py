@@ -294,14 +294,24 @@ def mask_raster(fn, mask):
 
     # open raster
     raster = gdal.Open(fn, gdal.GA_Update)
-    # mask raster
     for i in range(raster.RasterCount):
-        out_band = raster.GetRasterBand(i + 1)
-        out_data = out_band.ReadAsArray()
-        out_band.SetNoDataValue(0)
-        no_data_value = out_band.GetNoDataValue()
-        out_data[mask] = no_data_value
-        out_band.WriteArray(out_data)
+        raster.GetRasterBand(i + 1).SetNoDataValue(0)
+    # mask raster, all the bands are read and written in a single pass over the file
+    # (and not at all if there is nothing to mask)
+    if np.any(mask):
+        out_data = raster.ReadAsArray()
+        if out_data.ndim == 2:
+            out_data[mask] = 0
+        else:
+            out_data[:, mask] = 0
+        raster.WriteRaster(
+            0,
+            0,
+            raster.RasterXSize,
+            raster.RasterYSize,
+            out_data.tobytes(),
+            buf_type=raster.GetRasterBand(1).DataType,
+        )
     # close dataset and flush cache
     raster = None
 
@@ -374,6 +384,29 @@ def get_image_dimensions(image_path):
 ###################################################################################################
 
 
+# umask of the process, read once (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def set_default_permissions(filepath):
+    """
+    Gives a file the permissions of a file created with open(), 0o666 minus the umask.
+    tempfile.mkstemp creates its files readable by the owner only, which os.replace
+    keeps when the temporary file is moved to its final name.
+
+    Arguments:
+    -----------
+    filepath: str
+        path to the file
+
+    Returns:
+    -----------
+    None
+    """
+    os.chmod(filepath, 0o666 & ~_UMASK)
+
+
 def create_folder_structure(im_folder, satname):
     """
     Create the structure of subfolders for each satellite mission
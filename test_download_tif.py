@@ -8,7 +8,6 @@
 
 # load modules
 import os
-import numpy as np
 import pickle
 import warnings
 
@@ -18,55 +17,6 @@ import ee
 from coastsat import SDS_download, SDS_tools
 
 
-def adjust_polygon(polygon, proj, **kwargs):
-    """
-    Adjust polygon of ROI to fit exactly with the pixels of the underlying tile
-
-    KV WRL 2022
-
-    Arguments:
-    -----------
-    polygon: list
-        polygon containing the lon/lat coordinates to be extracted,
-        longitudes in the first column and latitudes in the second column,
-        there are 5 pairs of lat/lon with the fifth point equal to the first point:
-        ```
-        polygon = [[[151.3, -33.7],[151.4, -33.7],[151.4, -33.8],[151.3, -33.8],
-        [151.3, -33.7]]]
-        ```
-    proj: ee.Proj
-        projection of the underlying tile
-
-    Returns:
-    -----------
-    ee_region: ee
-        updated list of images
-    """
-    try:
-        # adjust polygon to match image coordinates so that there is no resampling
-        polygon_ee = ee.Geometry.Polygon(polygon)
-        # convert polygon to image coordinates
-        polygon_coords = np.array(
-            ee.List(polygon_ee.transform(proj, 1).coordinates().get(0)).getInfo()
-        )
-        print(polygon_coords)
-        # make it a rectangle
-        xmin = np.min(polygon_coords[:, 0])
-        ymin = np.min(polygon_coords[:, 1])
-        xmax = np.max(polygon_coords[:, 0])
-        ymax = np.max(polygon_coords[:, 1])
-        # round to the closest pixels
-        rect = [np.floor(xmin), np.floor(ymin), np.ceil(xmax), np.ceil(ymax)]
-        # convert back to epsg 4326
-        ee_region = ee.Geometry.Rectangle(rect, proj, True, False).transform(
-            "EPSG:4326"
-        )
-
-        return ee_region
-    except Exception as e:
-        raise e
-
-
 # region of interest (longitude, latitude in WGS84)
 polygon = [
     [
@@ -138,13 +88,16 @@ im_folder = (
 filepaths = SDS_tools.create_folder_structure(im_folder, satname)
 
 bands_id = bands_dict[satname]
-im_bands = image_ee.getInfo()["bands"]
+im_meta = image_ee.getInfo()
+im_bands = im_meta["bands"]
 # first delete dimensions key from dictionary
 # otherwise the entire image is extracted (don't know why)
 for j in range(len(im_bands)):
     del im_bands[j]["dimensions"]
-proj_ms = image_ee.select("B1").projection()
-ee_region_ms = adjust_polygon(polygon, proj_ms)
+# projection of the band from the image info (no extra request), the rectangle is
+# rounded on the server and only its 4 bounds are returned
+proj_ms = SDS_download.get_band_projection(im_meta, "B1")
+rect_ms = SDS_download.adjust_polygon(polygon, proj_ms, image_id=image_id)
 bands = {}
 bands["ms"] = [
     im_bands[_] for _ in range(len(im_bands)) if im_bands[_]["id"] in bands_id
@@ -153,7 +106,12 @@ fp_ms = filepaths[1]
 
 try:
     SDS_download.download_tif(
-        image_ee, ee_region_ms, bands["ms"], fp_ms, satname, image_id=image_id
+        image_ee,
+        SDS_download.get_pixel_grid(rect_ms, proj_ms, bands["ms"][0]),
+        bands["ms"],
+        fp_ms,
+        satname,
+        image_id=image_id,
     )
     raise AssertionError("RequestSizeExceededError was not raised")
 except SDS_download.RequestSizeExceededError:
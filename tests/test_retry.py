@@ -0,0 +1,66 @@
+import ee
+import pytest
+
+from coastsat import SDS_download
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "Too many concurrent aggregations.",
+        "Computation timed out.",
+        "Quota exceeded for quota metric 'Requests'.",
+        "Earth Engine capacity exceeded: deadline exceeded.",
+        "An internal error has occurred (request: 1234).",
+    ],
+)
+def test_is_retryable_transient_ee_errors(message):
+    assert SDS_download.is_retryable(ee.EEException(message))
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "User memory limit exceeded.",
+        "Total request size (52428800 bytes) must be less than or equal to 50331648 bytes.",
+        "Image.select: Pattern 'B10' did not match any bands.",
+        "Image.load: Image asset 'COPERNICUS/S2/XXX' not found.",
+    ],
+)
+def test_is_retryable_permanent_ee_errors(message):
+    assert not SDS_download.is_retryable(ee.EEException(message))
+
+
+def test_is_retryable_programming_errors():
+    assert not SDS_download.is_retryable(KeyError("id"))
+    assert not SDS_download.is_retryable(TypeError("bad argument"))
+    assert SDS_download.is_retryable(ConnectionError("reset by peer"))
+
+
+def test_retry_raises_permanent_ee_error_at_once(monkeypatch):
+    calls = []
+    monkeypatch.setattr(SDS_download.time, "sleep", lambda _: None)
+
+    @SDS_download.retry
+    def request():
+        calls.append(1)
+        raise ee.EEException("User memory limit exceeded.")
+
+    with pytest.raises(ee.EEException):
+        request()
+    assert len(calls) == 1
+
+
+def test_retry_retries_transient_ee_error(monkeypatch):
+    calls = []
+    monkeypatch.setattr(SDS_download.time, "sleep", lambda _: None)
+
+    @SDS_download.retry
+    def request():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ee.EEException("Too many concurrent aggregations.")
+        return "ok"
+
+    assert request() == "ok"
+    assert len(calls) == 3